@@ -0,0 +1,56 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+import platform
+import time
+
+import torch
+
+import matchbox
+
+DISTRIBUTIONS = ('uniform', 'bimodal', 'constant')
+
+def sample_lengths(rng, n, max_len, fill=1.0, dist='uniform'):
+    """Sample `n` example lengths in [1, max_len] whose mean is about
+    `fill * max_len`, so a batch padded to `max_len` is about `fill` valid.
+    `uniform` spreads lengths evenly around the mean, `bimodal` mixes
+    full-length and length-one examples, and `constant` ignores `fill`."""
+    if dist == 'constant':
+        return [max_len] * n
+    mean = max(1.0, min(fill * max_len, max_len))
+    if dist == 'uniform':
+        spread = min(mean - 1, max_len - mean)
+        return [rng.randint(int(round(mean - spread)), int(round(mean + spread)))
+                for _ in range(n)]
+    if dist == 'bimodal':
+        p = (mean - 1) / (max_len - 1) if max_len > 1 else 1.0
+        return [max_len if rng.random() < p else 1 for _ in range(n)]
+    raise ValueError("unknown length distribution {!r}".format(dist))
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+def timeit(fn, *args, repeat=10, warmup=1, device='cpu'):
+    """Mean wall time of `fn(*args)` in seconds."""
+    for _ in range(warmup):
+        fn(*args)
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+def environment(device='cpu'):
+    """Versions and hardware to record alongside benchmark results."""
+    env = {'matchbox': matchbox.__version__, 'torch': torch.__version__,
+           'python': platform.python_version(),
+           'machine': platform.machine(), 'device': str(device),
+           'threads': torch.get_num_threads()}
+    if torch.device(device).type == 'cuda':
+        env['gpu'] = torch.cuda.get_device_name(torch.device(device))
+    return env
@@ -0,0 +1,67 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+"""Time new_zeros with a dynamic size (as used by @batch RNN code to create
+initial states) against the per-example loop it replaced, across batch sizes.
+
+    python benchmarks/new_zeros.py --batch-sizes 16 64 256 1024
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+import matchbox
+from matchbox import MaskedBatch
+
+def loop_new_zeros(x, sizes, d):
+    # the construction used before masks were built from lengths
+    bs, maxlen = sizes.size(0), int(sizes.max())
+    data = x.new_zeros(bs, maxlen, d)
+    mask = x.new_zeros(bs, maxlen, 1)
+    for i in range(bs):
+        mask[i:i + 1, :int(sizes[i])] = 1
+    return MaskedBatch(data, mask, (True, False))
+
+def batched_new_zeros(x, sizes, d):
+    out = x.new_zeros(x.size(0), sizes, d)
+    out.mask # force the lazily-built mask so both sides do the same work
+    return out
+
+def timeit(fn, *args, repeat=20):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[16, 64, 256, 1024])
+    parser.add_argument('--max-len', type=int, default=50)
+    parser.add_argument('--d', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    random.seed(0)
+    print('{:>8} {:>12} {:>12} {:>8}'.format(
+        'batch', 'loop (ms)', 'batched (ms)', 'speedup'))
+    for bs in args.batch_sizes:
+        xs = [torch.rand(1, random.randint(1, args.max_len), args.d)
+              for _ in range(bs)]
+        x = MaskedBatch.fromlist(xs, (True, False))
+        sizes = x.size_as_tensor(1)
+        loop = timeit(loop_new_zeros, x.data, sizes.data, args.d,
+                      repeat=args.repeat)
+        batched = timeit(batched_new_zeros, x, sizes, args.d,
+                         repeat=args.repeat)
+        print('{:>8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+            bs, loop * 1e3, batched * 1e3, loop / batched))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+"""Time matchbox.functional ops on MaskedBatches against a loop over the
+unbatched examples and against the same op on the padded data as a plain
+Tensor, across batch sizes, length distributions and fill ratios, and emit
+the results as JSON.
+
+    python -m benchmarks.ops --output ops.json
+    python -m benchmarks.ops --ops softmax_dynamic matmul --batch-sizes 64 --fills 0.5
+"""
+
+import argparse
+import itertools
+import json
+import random
+import sys
+
+import torch
+
+import matchbox
+from matchbox import MaskedBatch
+from matchbox import functional as F
+
+from . import DISTRIBUTIONS, environment, sample_lengths, timeit
+
+# each op takes a batch (or an example, or a padded Tensor) of size
+# B x T x D with dynamic T, and a D x D weight
+OPS = {
+    'add': lambda x, w: x + x,
+    'mul_tensor': lambda x, w: x * w[0],
+    'relu': lambda x, w: F.relu(x),
+    'tanh': lambda x, w: F.tanh(x),
+    'softmax_static': lambda x, w: F.softmax(x, -1),
+    'softmax_dynamic': lambda x, w: F.softmax(x, 1),
+    'matmul': lambda x, w: x @ x.transpose(1, 2),
+    'linear': lambda x, w: F.linear(x, w),
+    'split_join_dims': lambda x, w: x.split_dim(-1, 4).join_dims(0, -1),
+    'transpose': lambda x, w: x.transpose(1, 2),
+    'cat': lambda x, w: F.cat([x, x], 2),
+    'sum': lambda x, w: x.sum(1),
+    'mean_static': lambda x, w: x.mean(-1),
+    'layer_norm': lambda x, w: F.layer_norm(x, w.size()[-1:], w[0], w[1]),
+}
+
+def make_inputs(bs, dist, fill, args):
+    """The examples, their MaskedBatch and the weight for one configuration,
+    which every op is timed on. Lengths are drawn from an rng seeded by the
+    configuration, so they don't depend on which other ops or configurations
+    are run."""
+    rng = random.Random('{} {} {} {}'.format(args.seed, bs, dist, fill))
+    lengths = sample_lengths(rng, bs, args.max_len, fill, dist)
+    xs = [torch.rand(1, n, args.d, device=args.device) for n in lengths]
+    w = torch.rand(args.d, args.d, device=args.device)
+    return xs, MaskedBatch.fromlist(xs, (True, False)), w
+
+def run(op, xs, x, w, args):
+    fn = OPS[op]
+    kwargs = dict(repeat=args.repeat, device=args.device)
+    masked = timeit(fn, x, w, **kwargs)
+    loop = timeit(lambda xs, w: [fn(xi, w) for xi in xs], xs, w, **kwargs)
+    dense = timeit(fn, x.data, w, **kwargs)
+    return {'op': op, 'masked_ms': masked * 1e3, 'loop_ms': loop * 1e3,
+            'dense_ms': dense * 1e3}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ops', nargs='+', default=sorted(OPS),
+                        choices=sorted(OPS))
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[8, 32, 128])
+    parser.add_argument('--distributions', nargs='+',
+                        default=['uniform', 'bimodal'], choices=DISTRIBUTIONS)
+    parser.add_argument('--fills', type=float, nargs='+',
+                        default=[0.25, 0.5, 0.9])
+    parser.add_argument('--max-len', type=int, default=64)
+    parser.add_argument('--d', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    results = []
+    with matchbox.patched(), torch.no_grad():
+        for bs, dist, fill in itertools.product(
+                args.batch_sizes, args.distributions, args.fills):
+            xs, x, w = make_inputs(bs, dist, fill, args)
+            lengths = [xi.size(1) for xi in xs]
+            config = {'batch_size': bs, 'distribution': dist,
+                      'target_fill': fill,
+                      'fill': sum(lengths) / (bs * max(lengths)),
+                      'max_len': args.max_len, 'd': args.d}
+            for op in args.ops:
+                results.append(dict(config, **run(op, xs, x, w, args)))
+                if args.output:
+                    print('{op:>16} {batch_size:>5} {distribution:>8} '
+                          'fill {fill:4.2f}/{target_fill:4.2f} '
+                          'masked {masked_ms:8.3f} loop {loop_ms:8.3f} '
+                          'dense {dense_ms:8.3f} ms'.format(**results[-1]))
+    report = {'benchmark': 'ops', 'environment': environment(args.device),
+              'config': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+"""Measure end-to-end throughput of the example Transformer on a synthetic
+corpus, for batched and unbatched training steps and inference, and emit the
+results as JSON. Runs offline, on CPU by default. Requires PyTorch 0.4.1 or
+later (for devices and peak memory statistics).
+
+    python -m benchmarks.throughput --output throughput.json
+    python -m benchmarks.throughput --distribution bimodal --fill 0.3 --sort
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+import matchbox
+from matchbox import MaskedBatch
+
+from . import DISTRIBUTIONS, environment, sample_lengths, synchronize
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples'))
+from transformer import Transformer
+
+class SyntheticField(object):
+    # stands in for the torchtext Field that Transformer takes its vocab size
+    # from (and attaches its output layer to)
+
+    def __init__(self, vocab_size):
+        self.vocab = range(vocab_size)
+
+def synthetic_corpus(rng, n, vocab_size, max_len, fill, dist):
+    """`n` pairs of random source and target token sequences with lengths
+    drawn by `sample_lengths` (targets have at least two tokens, since the
+    model predicts `trg[1:]` from `trg[:-1]`)."""
+    src = sample_lengths(rng, n, max_len, fill, dist)
+    trg = sample_lengths(rng, n, max_len, fill, dist)
+    return [([rng.randrange(vocab_size) for _ in range(s)],
+             [rng.randrange(vocab_size) for _ in range(max(t, 2))])
+            for s, t in zip(src, trg)]
+
+def make_batches(corpus, batch_size, sort=False, device='cpu'):
+    """Group the corpus into MaskedBatches of `src` and `trg`, optionally
+    after sorting it by length like a bucketing iterator would."""
+    if sort:
+        corpus = sorted(corpus, key=lambda ex: (len(ex[1]), len(ex[0])))
+    batches = []
+    for i in range(0, len(corpus), batch_size):
+        chunk = corpus[i:i + batch_size]
+        src, trg = ([torch.tensor([seq], device=device) for seq in seqs]
+                    for seqs in zip(*chunk))
+        batches.append(argparse.Namespace(
+            src=MaskedBatch.fromlist(src, (True,)),
+            trg=MaskedBatch.fromlist(trg, (True,))))
+    return batches
+
+def count_tokens(batch):
+    """Number of real and padded tokens in a batch."""
+    real = padded = 0
+    for x in (batch.src, batch.trg):
+        real += int(x.size_as_tensor(1).data.sum())
+        padded += x.data.numel()
+    return real, padded
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+def memory_method(device):
+    """How `peak_memory_mb` is measured. On GPU, by the CUDA allocator's peak,
+    which is reset before each mode. On CPU, by how far each mode raises the
+    peak resident set size of a subprocess that runs only that mode, above
+    what building the corpus and model took."""
+    if torch.device(device).type == 'cuda':
+        return 'cuda_max_memory_allocated'
+    return 'subprocess_max_rss_increase'
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+        return 0.0
+    return max_rss_mb()
+
+def peak_memory_mb(device, baseline):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return max_rss_mb() - baseline
+
+def measure(mode, batched, model, batches, args):
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+
+    def step(b):
+        if mode == 'train':
+            model.train()
+            optimizer.zero_grad()
+            model.loss(b, unbatch=not batched).backward()
+            optimizer.step()
+        else:
+            model.eval()
+            with torch.no_grad():
+                if batched:
+                    model(b.src, b.trg[:, :-1])
+                else:
+                    for src, trg in zip(b.src.examples(), b.trg.examples()):
+                        model(src, trg[:, :-1])
+
+    baseline = reset_peak_memory(args.device)
+    for b in batches[:args.warmup]:
+        step(b)
+    synchronize(args.device)
+    real = padded = 0
+    start = time.perf_counter()
+    for b in batches[args.warmup:]:
+        step(b)
+        n, p = count_tokens(b)
+        real, padded = real + n, padded + p
+    synchronize(args.device)
+    elapsed = time.perf_counter() - start
+    return {'mode': mode, 'batched': batched,
+            'batches': len(batches) - args.warmup, 'tokens': real,
+            'seconds': elapsed, 'tokens_per_s': real / elapsed,
+            'padding': 1 - real / padded if batched else 0.0,
+            'peak_memory_mb': peak_memory_mb(args.device, baseline)}
+
+def measure_isolated(mode, batched):
+    # rerun this script for just one mode, so that the peak RSS it reports
+    # is not shared with the other modes or the parent's own setup
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    argv = [sys.executable, '-m', 'benchmarks.throughput'] + sys.argv[1:]
+    out = subprocess.run(argv + ['--only', mode, str(int(batched))],
+                         cwd=root, stdout=subprocess.PIPE, check=True,
+                         universal_newlines=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-len', type=int, default=40)
+    parser.add_argument('--fill', type=float, default=0.5)
+    parser.add_argument('--distribution', default='uniform',
+                        choices=DISTRIBUTIONS)
+    parser.add_argument('--sort', action='store_true',
+                        help='sort the corpus by length before batching')
+    parser.add_argument('--vocab-size', type=int, default=1000)
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--d-hidden', type=int, default=256)
+    parser.add_argument('--n-heads', type=int, default=4)
+    parser.add_argument('--n-layers', type=int, default=2)
+    parser.add_argument('--drop-ratio', type=float, default=0.1)
+    parser.add_argument('--modes', nargs='+', default=['train', 'infer'],
+                        choices=['train', 'infer'])
+    parser.add_argument('--no-unbatched', action='store_true',
+                        help='skip the (slow) per-example loops')
+    parser.add_argument('--pack-below', type=float, default=0,
+                        help='fill ratio below which position-wise ops pack')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--only', nargs=2, metavar=('MODE', 'BATCHED'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    isolate = torch.device(args.device).type != 'cuda' and not args.only
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+    corpus = synthetic_corpus(
+        rng, (args.batches + args.warmup) * args.batch_size, args.vocab_size,
+        args.max_len, args.fill, args.distribution)
+    batches = make_batches(corpus, args.batch_size, args.sort, args.device)
+    field = SyntheticField(args.vocab_size)
+    model_args = argparse.Namespace(
+        d_model=args.d_model, d_hidden=args.d_hidden, n_heads=args.n_heads,
+        n_layers=args.n_layers, drop_ratio=args.drop_ratio, length_ratio=1.5)
+    if args.only:
+        # run by measure_isolated: report one mode as a single line of JSON
+        mode, batched = args.only[0], bool(int(args.only[1]))
+        with matchbox.patched(), matchbox.pack_below(args.pack_below):
+            model = Transformer(field, field, model_args).to(args.device)
+            print(json.dumps(measure(mode, batched, model, batches, args)))
+        return
+    results = []
+    with matchbox.patched(), matchbox.pack_below(args.pack_below):
+        if not isolate:
+            model = Transformer(field, field, model_args).to(args.device)
+        for mode in args.modes:
+            for batched in (True,) if args.no_unbatched else (True, False):
+                results.append(measure_isolated(mode, batched) if isolate else
+                               measure(mode, batched, model, batches, args))
+                if args.output:
+                    print('{mode:>5} {0:>9} {tokens_per_s:10.1f} tokens/s '
+                          'padding {padding:5.1%} peak {peak_memory_mb:8.1f} '
+                          'MB'.format('batched' if batched else 'unbatched',
+                                      **results[-1]))
+    report = {'benchmark': 'throughput', 'environment': environment(args.device),
+              'config': vars(args),
+              'memory_method': memory_method(args.device),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,9 @@
 
 import torch
 from torch import nn
-from torchtext import data, datasets
 
 import matchbox
 from matchbox import functional as F
-from matchbox.data import MaskedBatchField
 
 import argparse
 import math
@@ -40,9 +38,8 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.gamma * (x - mean) / (std + self.eps) + self.beta
+        return F.layer_norm(x, self.gamma.size(), self.gamma, self.beta,
+                            self.eps)
 
 class FeedForward(nn.Module):
 
@@ -75,12 +72,8 @@ class Attention(nn.Module):
         self.causal = causal
 
     def forward(self, query, key, value):
-        dot_products = query @ key.transpose(1, 2)
-
-        if self.causal and query.dim() == 3:
-            dot_products = dot_products.causal_mask(in_dim=2, out_dim=1)
-
-        return self.dropout((dot_products / self.scale).softmax()) @ value
+        return F.attention(query, key, value, self.causal and query.dim() > 2,
+                           1 / self.scale, self.dropout.p, self.training)
 
 class MultiHead(nn.Module):
 
@@ -95,12 +88,12 @@ class MultiHead(nn.Module):
 
     def forward(self, query, key, value):
         query, key, value = self.wq(query), self.wk(key), self.wv(value)
-        # B x T x D -> B x T x (D/N) x N -> (B*N) x T x (D/N)
-        query, key, value = (x.split_dim(-1, self.n_heads).join_dims(0, -1)
+        # B x T x D -> B x T x (D/N) x N -> B x N x T x (D/N)
+        query, key, value = (x.split_dim(-1, self.n_heads).permute(0, 3, 1, 2)
                              for x in (query, key, value))
         outputs = self.attention(query, key, value)
-        # (B*N) x T x (D/N) -> B x N x T x (D/N) -> B x T x D
-        outputs = outputs.split_dim(0, self.n_heads).join_dims(-1, 1)
+        # B x N x T x (D/N) -> B x T x (D/N) x N -> B x T x D
+        outputs = outputs.permute(0, 2, 3, 1).join_dims(-2, -1)
         return self.wo(outputs)
 
 class EncoderLayer(nn.Module):
@@ -175,14 +168,17 @@ class Decoder(nn.Module):
         self.field = field
         self.length_ratio = args.length_ratio
 
-    def forward(self, x, encoding):
+    def hidden(self, x, encoding):
         x = F.embedding(x, self.out.weight * math.sqrt(self.d_model))
         x += positional_encodings_like(x)
         x = self.dropout(x)
 
         for l, (layer, enc) in enumerate(zip(self.layers, encoding)):
             x = layer(x, enc)
-        return self.out(x)
+        return x
+
+    def forward(self, x, encoding):
+        return self.out(self.hidden(x, encoding))
 
 class Transformer(nn.Module):
 
@@ -216,14 +212,19 @@ class Transformer(nn.Module):
         if unbatch:
             loss = 0
             for src, trg in zip(batch.src.examples(), batch.trg.examples()):
-                logits = self(src, trg[:, :-1])
-                loss += F.cross_entropy(logits, trg[:, 1:], reduce=reduce)
+                loss += self.loss(argparse.Namespace(src=src, trg=trg), reduce)
             return loss
-        logits = self(batch.src, batch.trg[:, :-1])
-        return F.cross_entropy(logits, batch.trg[:, 1:], reduce=reduce)
+        # project only the real target tokens onto the vocabulary
+        hidden = self.decoder.hidden(batch.trg[:, :-1],
+                                     self.encoder(batch.src))
+        out = self.decoder.out
+        return F.linear_cross_entropy(hidden, batch.trg[:, 1:], out.weight,
+                                      out.bias, reduce=reduce)
 
 if __name__ == '__main__':
     import sys
+    from torchtext import data, datasets
+    from matchbox.data import MaskedBatchField
     unbatch = sys.argv[1] == '1'
     small = sys.argv[2] == '1'
     if sys.argv[3] == '1':
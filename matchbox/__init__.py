@@ -6,20 +6,73 @@
 
 import torch
 
-from .compat import TENSOR_TYPE
+from .compat import TENSOR_TYPE, MASK_DTYPE
+from . import packing
+
+__version__ = '0.1.0'
+
+def _mask_from_lengths(lengths, data, dims):
+    """Mask of size batch x (size or 1 per dim) for data from a tuple with a
+    batch-size tensor of lengths per dynamic dim."""
+    bs, mask = data.size(0), None
+    for d, (length, b) in enumerate(zip(lengths, dims)):
+        if not b:
+            continue
+        size = data.size(d + 1)
+        positions = torch.arange(0, size, out=length.new(size))
+        m = positions.unsqueeze(0) < length.unsqueeze(1)
+        m = m.view(bs, *(size if e == d else 1 for e in range(len(dims))))
+        mask = m if mask is None else mask * m
+    if mask is None:
+        mask = data.new(bs, *(1 for _ in dims)).fill_(1).ne(0)
+    return mask
 
 class MaskedBatch(object):
 
-    def __init__(self, data, mask, dims):
-        if data.dim() != mask.dim() or mask.dim() != len(dims) + 1:
+    def __init__(self, data, mask, dims, lengths=None, all_valid=False):
+        if mask is None:
+            if (lengths is None and not all_valid) or (
+                    lengths is not None and len(lengths) != len(dims)) or (
+                    data.dim() != len(dims) + 1):
+                raise ValueError("malformed MaskedBatch {} with:\n data: "
+                                 " {}\n lengths: {}".format(
+                    repr(dims), repr(data), repr(lengths)))
+        elif data.dim() != mask.dim() or mask.dim() != len(dims) + 1:
             raise ValueError("malformed MaskedBatch {} with:\n data: "
                              " {}\n mask: {}".format(
                 repr(dims), repr(data), repr(mask)))
         if isinstance(mask, TENSOR_TYPE) and mask.requires_grad:
             raise ValueError("mask cannot require grad")
+        if mask is not None and getattr(mask, 'dtype', None) != MASK_DTYPE:
+            mask = mask.ne(0)
         self.data = data
-        self.mask = mask
+        self._mask = mask
         self.dims = dims
+        # lengths, if not None, has a batch-size tensor of example sizes for
+        # each dynamic dim (and None for each static dim) and fully
+        # determines the mask, which is then only built when first needed
+        self.lengths = lengths
+        # all_valid means the mask is known to be all ones, so ops can skip
+        # masking arithmetic entirely
+        self.all_valid = all_valid
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            if self.all_valid:
+                self._mask = self.data.new(self.data.size(0), *(
+                    s if b else 1 for s, b in zip(self.data.size()[1:],
+                                                  self.dims))).fill_(1).ne(0)
+            else:
+                self._mask = _mask_from_lengths(
+                    self.lengths, self.data, self.dims)
+        return self._mask
+
+    def _masked_data(self, value=0):
+        # data with every padding entry set to value
+        if self.all_valid:
+            return self.data
+        return self.data.masked_fill(self.mask.eq(0), value)
 
     @classmethod
     def fromlist(cls, examples, dims):
@@ -27,24 +80,136 @@ class MaskedBatch(object):
         bs = len(examples)
         sizes = [max(x.size(d + 1) for x in examples)
                  for d in range(len(dims))]
-        data = examples[0].new(bs, *sizes).zero_()
-        mask_sizes = [s if dims[d] else 1 for d, s in enumerate(sizes)]
-        mask = examples[0].new(bs, *mask_sizes).zero_()
-        mask.requires_grad = False
-        for i, x in enumerate(examples):
-            inds = [slice(0, x.size(d + 1)) if b else slice(None)
-                    for d, b in enumerate(dims)]
-            data[(slice(i, i + 1), *inds)] = x
-            mask[(slice(i, i + 1), *inds)] = 1
-        return cls(data, mask, dims)
+        if not any(dims):
+            data = torch.cat(examples, 0)
+            return cls(data, None, dims, tuple(None for _ in dims), True)
+        lengths = tuple(torch.LongTensor([x.size(d + 1) for x in examples])
+                        if b else None for d, b in enumerate(dims))
+        values = torch.cat([x.contiguous().view(-1) for x in examples], 0)
+        return cls._scatter(values, lengths, sizes, dims)
+
+    @classmethod
+    def frompacked(cls, values, lengths, dims):
+        """Build a batch from the examples' entries concatenated along
+        dimension 1, which must be the only dynamic dimension, and a tensor
+        or list of their lengths in that dimension."""
+        if len(dims) == 0 or not dims[0] or any(dims[1:]):
+            raise ValueError("frompacked requires dimension 1 to be the only "
+                             "dynamic dimension, got {}".format(repr(dims)))
+        if not torch.is_tensor(lengths):
+            lengths = torch.LongTensor(list(lengths))
+        sizes = [int(lengths.max())] + list(values.size()[1:])
+        lengths = (lengths,) + tuple(None for _ in dims[1:])
+        return cls._scatter(values.contiguous().view(-1), lengths, sizes, dims)
+
+    @classmethod
+    def _scatter(cls, values, lengths, sizes, dims):
+        # values holds every example flattened and concatenated; because each
+        # example fills a box in the corner of its slice of data, a boolean
+        # index with the mask visits its entries in the same order.
+        if values.is_cuda:
+            lengths = tuple(l if l is None or l.is_cuda
+                            else l.cuda(values.get_device()) for l in lengths)
+        bs = next(l.size(0) for l in lengths if l is not None)
+        if all(l is None or bool((l == s).all())
+               for l, s in zip(lengths, sizes)):
+            data = values.view(bs, *sizes)
+            return cls(data, None, dims, lengths, True)
+        data = values.new(bs, *sizes).zero_()
+        index = _mask_from_lengths(lengths, data, dims)
+        data[index.expand_as(data)] = values
+        return cls(data, index, dims, lengths)
 
     def examples(self):
-        data, mask, dims = self.data, self.mask.data.long(), self.dims
-        for i in range(data.maxsize(0)):
-            inds = tuple(slice(0, mask[i].sum(d, keepdim=True)[
-                tuple(0 for _ in dims)])
-                if b else slice(None) for d, b in enumerate(dims))
-            yield data[(slice(i, i + 1), *inds)]
+        return iter(self.unbatch())
+
+    def unbatch(self, numpy=False):
+        """Split the batch into a list of its examples, each with batch size
+        one. The examples are views of `data`; with `numpy=True` they are
+        views of a single NumPy copy of it."""
+        data = self.data.data.cpu().numpy() if numpy else self.data
+        if not any(self.dims):
+            return [data[i:i + 1] for i in range(len(data))]
+        lengths = torch.stack(self._dynamic_lengths(), 1).tolist()
+        examples = []
+        for i, lens in enumerate(lengths):
+            lens = iter(lens)
+            inds = tuple(slice(0, next(lens)) if b else slice(None)
+                         for b in self.dims)
+            examples.append(data[(slice(i, i + 1),) + inds])
+        return examples
+
+    def _dynamic_lengths(self):
+        # list of batch-size tensors of example sizes, one per dynamic dim
+        if self.lengths is not None:
+            return [l for l, b in zip(self.lengths, self.dims) if b]
+        mask, bs = self.mask.data.ne(0), self.mask.size(0)
+        return [mask.transpose(1, d + 1).contiguous().view(
+                    bs, mask.size(d + 1), -1).max(2)[0].long().sum(1)
+                for d, b in enumerate(self.dims) if b]
+
+    def sort_by_length(self, dim=1, descending=True):
+        """Reorder the examples by their size in dynamic dimension `dim`.
+        Returns the reordered batch (trimmed to its new maximum sizes) and
+        the permutation that restores the original order, which can be
+        passed to `index_select(0, ...)` on the outputs of a model."""
+        if dim < 0:
+            dim += self.dim()
+        if dim == 0 or not self.dims[dim - 1]:
+            raise ValueError("can only sort by the size of a dynamic dim")
+        lengths = self._dynamic_lengths()[sum(self.dims[:dim - 1])]
+        order = lengths.sort(0, descending)[1]
+        return self.index_select(0, order)._trim(), order.sort(0)[1]
+
+    def regroup(self, max_tokens, dim=1):
+        """Split the batch into sub-batches of examples with similar sizes
+        in dynamic dimension `dim`, each holding at most `max_tokens`
+        positions counting padding (its number of examples times its padded
+        size in that dimension), but at least one example.
+        Returns the sub-batches and the permutation that restores the
+        original order; see `ungroup`."""
+        batch, inverse = self.sort_by_length(dim)
+        if dim < 0:
+            dim += self.dim()
+        lengths = batch._dynamic_lengths()[sum(self.dims[:dim - 1])].tolist()
+        groups, start = [], 0
+        for i in range(1, len(lengths) + 1):
+            if i == len(lengths) or (i - start + 1) * lengths[start] > (
+                    max_tokens):
+                index = torch.arange(start, i, out=inverse.new(i - start))
+                groups.append(batch.index_select(0, index)._trim())
+                start = i
+        return groups, inverse
+
+    @staticmethod
+    def ungroup(outputs, inverse):
+        """Combine per-sub-batch outputs (of `regroup` sub-batches) back into
+        one batch in the original order."""
+        if not isinstance(outputs[0], MaskedBatch):
+            return torch.cat(outputs, 0).index_select(0, inverse)
+        examples = [x for output in outputs for x in output.unbatch()]
+        return MaskedBatch.fromlist([examples[i] for i in inverse.tolist()],
+                                    outputs[0].dims)
+
+    def _trim(self):
+        # narrow dynamic dims to the largest example, e.g. after selecting
+        # a subset of the examples
+        if not any(self.dims):
+            return self
+        lengths = self._dynamic_lengths()
+        maxes = iter(int(l.max()) for l in lengths)
+        sizes = [next(maxes) if b else s
+                 for s, b in zip(self.data.size()[1:], self.dims)]
+        data = self.data[(slice(None),) + tuple(slice(0, s) for s in sizes)]
+        if self.lengths is not None:
+            # only lengths-based masks are known to be boxes, so equal sizes
+            # mean no padding
+            all_valid = all(bool(l.eq(l.max()).all()) for l in lengths)
+            return MaskedBatch(data, None, self.dims, self.lengths, all_valid)
+        mask = self.mask[(slice(None),) + tuple(
+            slice(0, s) if b else slice(None)
+            for s, b in zip(sizes, self.dims))]
+        return MaskedBatch(data, mask, self.dims)
 
     def __repr__(self):
         return "MaskedBatch {} with:\n data: {}\n mask: {}".format(
@@ -52,6 +217,13 @@ class MaskedBatch(object):
 
     def cuda(self, *args, **kwargs):
         data = self.data.cuda(*args, **kwargs)
+        if self.lengths is not None:
+            lengths = tuple(None if l is None else l.cuda(*args, **kwargs)
+                            for l in self.lengths)
+            return self.__class__(data, None, self.dims, lengths,
+                                  self.all_valid)
+        if self.all_valid:
+            return self.__class__(data, None, self.dims, None, True)
         mask = self.mask.cuda(*args, **kwargs)
         return self.__class__(data, mask, self.dims)
 
@@ -90,8 +262,164 @@ class MaskedBatch(object):
                              "code containing control flow in @batch.")
         return bool(self.data)
 
-from . import functional
+    def pack(self):
+        return PackedBatch.frombatch(self)
+
+    def _maybe_pack(self):
+        # called by position-wise ops; only batches with lengths qualify, since
+        # those are known to hold each example's entries at the start of dim 1
+        threshold = packing.THRESHOLD
+        if (threshold <= 0 or self.all_valid or self.lengths is None or
+                not self.dims or not self.dims[0] or any(self.dims[1:])):
+            return self
+        if getattr(self, '_fill', None) is None:
+            # computed once per batch, since reading it syncs with the device
+            size = self.data.size(0) * self.data.size(1)
+            self._fill = int(self.lengths[0].sum()) / size
+        if self._fill >= threshold:
+            return self
+        # cached so that several ops on the same batch (e.g., the query, key
+        # and value projections in self-attention) share one gather, for as
+        # long as neither the data nor the packed values change in place
+        cached = getattr(self, '_packed', None)
+        if cached is not None:
+            packed, versions = cached
+            if versions == (self.data._version, packed.values._version):
+                return packed
+        packed = self.pack()
+        self._packed = packed, (self.data._version, packed.values._version)
+        return packed
+
+class PackedBatch(MaskedBatch):
+    """A MaskedBatch stored without padding.
+
+    `values` holds the valid entries of every example concatenated along the
+    packed dimension (dimension 1, which must be the only dynamic dimension)
+    and `lengths[0]` holds the size of each example in that dimension. Ops that
+    know about packing work on `values` directly; anything else sees the
+    ordinary padded `data` and `mask`, which are built on first access and
+    then cached.
+    """
+
+    def __init__(self, values, lengths, dims):
+        if len(dims) == 0 or not dims[0] or any(dims[1:]):
+            raise ValueError("PackedBatch requires dimension 1 to be its only "
+                             "dynamic dimension, got {}".format(repr(dims)))
+        if values.dim() != len(dims):
+            raise ValueError("malformed PackedBatch {} with:\n values: "
+                             "{}\n lengths: {}".format(
+                repr(dims), repr(values), repr(lengths)))
+        if not isinstance(lengths, tuple):
+            lengths = (lengths,)
+        self.values = values
+        self.lengths = lengths[:1] + tuple(None for _ in dims[1:])
+        self.dims = dims
+        self._padded = None
+        self._all_valid = None
+
+    @classmethod
+    def fromlist(cls, examples, dims):
+        values = torch.cat([x.squeeze(0) for x in examples], 0)
+        lengths = torch.LongTensor([x.size(1) for x in examples])
+        if values.is_cuda:
+            lengths = lengths.cuda(values.get_device())
+        return cls(values, lengths, dims)
+
+    @classmethod
+    def frompacked(cls, values, lengths, dims):
+        if not torch.is_tensor(lengths):
+            lengths = torch.LongTensor(list(lengths))
+        return cls(values, lengths, dims)
+
+    @classmethod
+    def frombatch(cls, batch):
+        if isinstance(batch, PackedBatch):
+            return batch
+        lengths = batch._dynamic_lengths()[0]
+        mask = batch.mask[(slice(None), slice(None),
+                           *(0 for _ in batch.dims[1:]))].ne(0)
+        return cls(batch.data[mask], lengths, batch.dims)
+
+    @property
+    def offsets(self):
+        return self.lengths[0].cumsum(0) - self.lengths[0]
+
+    def padded(self):
+        if self._padded is None:
+            sizes = [int(self.lengths[0].max())] + list(self.values.size()[1:])
+            self._padded = MaskedBatch._scatter(
+                self.values.contiguous().view(-1), self.lengths, sizes,
+                self.dims)
+        return self._padded
+
+    @property
+    def data(self):
+        return self.padded().data
+
+    @property
+    def mask(self):
+        return self.padded().mask
+
+    @property
+    def all_valid(self):
+        # from the lengths (once), so that checking it never builds `data`
+        if self._all_valid is None:
+            lengths = self.lengths[0]
+            self._all_valid = bool(lengths.eq(lengths.max()).all())
+        return self._all_valid
+
+    def unbatch(self, numpy=False):
+        values = self.values.data.cpu().numpy() if numpy else self.values
+        examples, offset = [], 0
+        for length in self.lengths[0].tolist():
+            examples.append(values[None, offset:offset + length])
+            offset += length
+        return examples
+
+    def __repr__(self):
+        return "PackedBatch {} with:\n values: {}\n lengths: {}".format(
+            repr(self.dims), repr(self.values), repr(self.lengths[0]))
+
+    def cuda(self, *args, **kwargs):
+        values = self.values.cuda(*args, **kwargs)
+        lengths = self.lengths[0].cuda(*args, **kwargs)
+        return self.__class__(values, lengths, self.dims)
+
+    @property
+    def is_cuda(self):
+        return self.values.is_cuda
+
+    def get_device(self):
+        return self.values.get_device()
+
+    def dim(self):
+        return len(self.dims) + 1
+
+    def size(self, dim=None):
+        if dim is None or dim == 1 or dim == 1 - self.dim():
+            raise ValueError("use size_as_tensor for dynamic dimensions")
+        if dim < 0:
+            dim += self.dim()
+        if dim == 0:
+            return self.lengths[0].size(0)
+        return self.values.size(dim - 1)
+
+    def new(self, *sizes):
+        return self.values.new(*sizes)
+
+    def pack(self):
+        return self
+
+    def _maybe_pack(self):
+        return self
+
+from . import patching
+from .patching import patched
+if not patching.LAZY:
+    from . import functional
 from .macro import batch
+from .profiler import profile
+from .packing import pack_below
 
 try:
     from . import data
@@ -37,7 +37,14 @@ if torch.__version__ < '0.4':
         return _old_arange(*args, out=out)
     torch.arange = _new_arange
 
+    MASK_DTYPE = None
+
 else:
     def identity(x): return x
     MAYBE_VARIABLE = identity
     TENSOR_TYPE = torch.Tensor
+    # masks use whatever type comparisons return (uint8 or bool)
+    MASK_DTYPE = torch.ones(1).ne(0).dtype
+
+# whether torch functions dispatch to MaskedBatch.__torch_function__
+TORCH_FUNCTION = hasattr(TENSOR_TYPE, '__torch_function__')
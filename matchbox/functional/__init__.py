@@ -6,7 +6,8 @@
 
 import torch
 
-from .nnet import dropout, linear, embedding, softmax, cross_entropy
+from .nnet import dropout, linear, embedding, softmax, log_softmax
+from .nnet import layer_norm, attention, cross_entropy, linear_cross_entropy
 from .elementwise import log, sqrt, sin, cos, tan, relu, tanh, sigmoid
 from .tensor_math import matmul
 from .indexing import getitem
@@ -16,6 +17,10 @@ from .tensor_shape import split_dim, join_dims, size_as_tensor, maxsize
 from .special import causal_mask
 from . import reduction
 from . import constructors
+from matchbox.compat import TORCH_FUNCTION
+from matchbox.patching import patch
+if TORCH_FUNCTION:
+    from . import dispatch
 
 import sys
 
@@ -27,16 +32,28 @@ import sys
 import torch.nn.modules.sparse
 import torch.nn.modules.linear
 import torch.nn.modules.dropout
-import torch.nn._functions.rnn
 
-torch.nn.modules.sparse.F = sys.modules[__name__]
-torch.nn.modules.linear.F = sys.modules[__name__]
-torch.nn.modules.dropout.F = sys.modules[__name__]
-torch.nn._functions.rnn.F = sys.modules[__name__]
+patch(torch.nn.modules.sparse, 'F', sys.modules[__name__])
+patch(torch.nn.modules.linear, 'F', sys.modules[__name__])
+patch(torch.nn.modules.dropout, 'F', sys.modules[__name__])
+
+try:
+    # the Python RNN cell implementations, removed in PyTorch 1.0
+    import torch.nn._functions.rnn
+except ImportError:
+    pass
+else:
+    patch(torch.nn._functions.rnn, 'F', sys.modules[__name__])
+
+if hasattr(torch.nn, 'LayerNorm'):
+    def layer_norm_forward(self, input):
+        return layer_norm(input, self.normalized_shape, self.weight,
+                          self.bias, self.eps)
+    patch(torch.nn.LayerNorm, 'forward', layer_norm_forward)
 
 if torch.__version__ < '0.4':
     def embed_forward(self, input):
         return embedding(
             input, self.weight, self.padding_idx, self.max_norm,
             self.norm_type, self.scale_grad_by_freq, self.sparse)
-    torch.nn.Embedding.forward = embed_forward
+    patch(torch.nn.Embedding, 'forward', embed_forward)
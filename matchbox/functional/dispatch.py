@@ -0,0 +1,104 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+import sys
+
+import torch
+from torch.nn import functional as F
+
+from matchbox import MaskedBatch
+from .elementwise import _elementwise_unary, _elementwise_binary
+
+# implementations of torch functions called with MaskedBatch arguments, which
+# MaskedBatch.__torch_function__ looks up (on PyTorch versions that support
+# the protocol; plain tensors never reach this table)
+HANDLED_FUNCTIONS = {}
+
+def implements(*fns):
+    """Register the decorated function as the implementation of `fns`."""
+    def decorator(impl):
+        for fn in fns:
+            HANDLED_FUNCTIONS[fn] = impl
+        return impl
+    return decorator
+
+def register_elementwise(fn, binary=False):
+    """Register a torch function as elementwise, so its output has the mask
+    of its input (or, if `binary`, of both inputs combined)."""
+    HANDLED_FUNCTIONS[fn] = (_elementwise_binary if binary
+                             else _elementwise_unary)(fn)
+
+def __torch_function__(cls, func, types, args=(), kwargs=None):
+    impl = HANDLED_FUNCTIONS.get(func)
+    if impl is None:
+        return NotImplemented
+    return impl(*args, **(kwargs or {}))
+
+MaskedBatch.__torch_function__ = classmethod(__torch_function__)
+
+def _method(name):
+    # torch.fn(batch, ...) -> batch.fn(...)
+    def inner(batch, *args, **kwargs):
+        if not isinstance(batch, MaskedBatch):
+            return NotImplemented
+        return getattr(batch, name)(*args, **kwargs)
+    return inner
+
+def _functional(name, *ignore):
+    # torch.fn(...) -> matchbox.functional.fn(...), looked up on each call so
+    # wrappers (e.g. matchbox.profile) apply; keyword arguments in `ignore`
+    # are dropped if they have their default value of None
+    def inner(*args, **kwargs):
+        for key in ignore:
+            if key.startswith('_') or kwargs.get(key) is None:
+                kwargs.pop(key, None)
+        return getattr(sys.modules['matchbox.functional'], name)(
+            *args, **kwargs)
+    return inner
+
+for _name in ('sum', 'mean', 'var', 'std', 'max', 'min', 'logsumexp',
+              'index_select', 'permute'):
+    if hasattr(torch, _name):
+        HANDLED_FUNCTIONS[getattr(torch, _name)] = _method(_name)
+if hasattr(torch, 'matmul'):
+    HANDLED_FUNCTIONS[torch.matmul] = _method('__matmul__')
+
+for _owner, _name, _ignore in (
+        (torch, 'cat', ()), (torch, 'stack', ()), (torch, 'unbind', ()),
+        (torch, 'split', ()), (torch, 'chunk', ()), (torch, 'transpose', ()),
+        (F, 'linear', ()), (F, 'embedding', ()), (F, 'dropout', ()),
+        (F, 'layer_norm', ()),
+        (F, 'softmax', ('_stacklevel', 'dtype')),
+        (torch, 'softmax', ('dtype',)),
+        (F, 'log_softmax', ('_stacklevel', 'dtype')),
+        (torch, 'log_softmax', ('dtype',))):
+    if hasattr(_owner, _name):
+        HANDLED_FUNCTIONS[getattr(_owner, _name)] = _functional(
+            _name, *_ignore)
+
+if hasattr(F, 'scaled_dot_product_attention'):
+    @implements(F.scaled_dot_product_attention)
+    def _scaled_dot_product_attention(query, key, value, attn_mask=None,
+                                      dropout_p=0.0, is_causal=False,
+                                      scale=None, **kwargs):
+        if attn_mask is not None or kwargs:
+            raise NotImplementedError("scaled_dot_product_attention on "
+                                      "MaskedBatch only supports is_causal")
+        return sys.modules['matchbox.functional'].attention(
+            query, key, value, is_causal, scale, dropout_p, dropout_p > 0)
+
+for _name in ('abs', 'neg', 'exp', 'log', 'sqrt', 'rsqrt', 'reciprocal',
+              'sin', 'cos', 'tan', 'tanh', 'sigmoid', 'relu', 'sign', 'floor',
+              'ceil', 'round', 'clamp', 'erf'):
+    if hasattr(torch, _name):
+        register_elementwise(getattr(torch, _name))
+for _name in ('relu', 'elu', 'leaky_relu', 'gelu', 'tanh', 'sigmoid'):
+    if hasattr(F, _name):
+        register_elementwise(getattr(F, _name))
+for _name in ('add', 'sub', 'mul', 'div', 'pow', 'atan2', 'eq', 'ne', 'lt',
+              'le', 'gt', 'ge', 'maximum', 'minimum'):
+    if hasattr(torch, _name):
+        register_elementwise(getattr(torch, _name), binary=True)
@@ -7,17 +7,26 @@
 import torch
 from torch.nn import functional as F
 
-from matchbox import MaskedBatch
-from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
+from matchbox import MaskedBatch, PackedBatch
+from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE, TORCH_FUNCTION
+from matchbox.patching import patch
 
 def _elementwise_unary(fn):
     def inner(batch, *args, **kwargs):
         if not isinstance(batch, MaskedBatch):
             return fn(batch, *args, **kwargs)
+        if not (kwargs.get('inplace') or
+                getattr(fn, '__name__', '').endswith('_')):
+            # in place, the caller's batch itself has to change
+            batch = batch._maybe_pack()
+        if isinstance(batch, PackedBatch):
+            values = fn(batch.values, *args, **kwargs)
+            return PackedBatch(values, batch.lengths, batch.dims)
         data = fn(batch.data, *args, **kwargs)
-        mask = batch.mask.type_as(data)
-        dims = batch.dims
-        return MaskedBatch(data, mask, dims)
+        if batch.lengths is not None or batch.all_valid:
+            return MaskedBatch(data, None, batch.dims, batch.lengths,
+                               batch.all_valid)
+        return MaskedBatch(data, batch.mask, batch.dims)
     return inner
 
 MaskedBatch.float = _elementwise_unary(TENSOR_TYPE.float)
@@ -40,18 +49,53 @@ MaskedBatch.relu = relu = _elementwise_unary(F.relu)
 MaskedBatch.tanh = tanh = _elementwise_unary(F.tanh)
 MaskedBatch.sigmoid = sigmoid = _elementwise_unary(F.sigmoid)
 
+def _packed_compatible(batch1, batch2):
+    if not isinstance(batch1, PackedBatch):
+        return False
+    if isinstance(batch2, PackedBatch):
+        return batch1.dims == batch2.dims and (
+            batch1.lengths[0] is batch2.lengths[0] or
+            batch1.lengths[0].equal(batch2.lengths[0]))
+    if isinstance(batch2, MaskedBatch):
+        return False
+    # tensors must broadcast against the static dims only
+    return not isinstance(batch2, TENSOR_TYPE) or (
+        batch2.dim() < batch1.values.dim())
+
+def _min_lengths(lengths1, lengths2):
+    if lengths1 is None or lengths2 is None:
+        return lengths2 if lengths1 is None else lengths1
+    return torch.min(lengths1, lengths2)
+
 def _elementwise_binary(fn):
     def inner(batch1, batch2, **kwargs):
         if not isinstance(batch1, MaskedBatch) and not isinstance(batch2, MaskedBatch):
             return fn(batch1, batch2, **kwargs)
+        if _packed_compatible(batch1, batch2):
+            values = fn(batch1.values, getattr(batch2, 'values', batch2),
+                        **kwargs)
+            return PackedBatch(values, batch1.lengths, batch1.dims)
         if isinstance(batch2, MaskedBatch):
             data = fn(batch1.data, batch2.data, **kwargs)
-            mask = batch1.mask * batch2.mask
             dims = tuple(b1 or b2 for b1, b2 in zip(batch1.dims, batch2.dims))
+            all_valid = batch1.all_valid and batch2.all_valid
+            if batch1.lengths is not None and batch2.lengths is not None:
+                lengths = tuple(_min_lengths(l1, l2) for l1, l2
+                                in zip(batch1.lengths, batch2.lengths))
+                return MaskedBatch(data, None, dims, lengths, all_valid)
+            if all_valid:
+                return MaskedBatch(data, None, dims, None, True)
+            mask = batch1.mask & batch2.mask
         else:
-            data = fn(batch1.data, batch2, **kwargs)
-            mask = batch1.mask.type_as(data)
-            dims = batch1.dims
+            if isinstance(batch1, MaskedBatch):
+                batch, data = batch1, fn(batch1.data, batch2, **kwargs)
+            else:
+                batch, data = batch2, fn(batch1, batch2.data, **kwargs)
+            dims = batch.dims
+            if batch.lengths is not None or batch.all_valid:
+                return MaskedBatch(data, None, dims, batch.lengths,
+                                   batch.all_valid)
+            mask = batch.mask
         return MaskedBatch(data, mask, dims)
     return inner
 
@@ -79,9 +123,16 @@ def _inject_arith(original, replacement):
         return original(self, other)
     return inner
 
-TENSOR_TYPE.__add__ = _inject_arith(TENSOR_TYPE.__add__, lambda a, b: b + a)
-TENSOR_TYPE.__sub__ = _inject_arith(TENSOR_TYPE.__sub__, lambda a, b: -b + a)
-TENSOR_TYPE.__mul__ = _inject_arith(TENSOR_TYPE.__mul__, lambda a, b: b * a)
+# with __torch_function__, tensor op batch already falls back to the batch's
+# reflected operator, so tensors don't need to pay for these checks
+if not TORCH_FUNCTION:
+    patch(TENSOR_TYPE, '__add__',
+          _inject_arith(TENSOR_TYPE.__add__, lambda a, b: b + a))
+    patch(TENSOR_TYPE, '__sub__',
+          _inject_arith(TENSOR_TYPE.__sub__, lambda a, b: -b + a))
+    patch(TENSOR_TYPE, '__mul__',
+          _inject_arith(TENSOR_TYPE.__mul__, lambda a, b: b * a))
+    patch(TENSOR_TYPE, '__matmul__',
+          _inject_arith(TENSOR_TYPE.__matmul__, lambda a, b: b.__rmatmul__(a)))
 # TODO fix __sub__; it's ugly
-# TENSOR_TYPE.__matmul__ = _inject_arith(TENSOR_TYPE.__matmul__, lambda a, b:)
 # TENSOR_TYPE.__truediv__ = _inject_arith(TENSOR_TYPE.__truediv__, lambda a, b:)
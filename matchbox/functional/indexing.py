@@ -27,11 +27,36 @@ def getitem(batch, index):
                                               "complex slice")
                 index[i + 1] = slice(-ind.stop, None)
     index = tuple(index)
-    mask = batch.mask[tuple(i if b else 0 if isinstance(i, int) else slice(None)
-                       for i, b in zip(index, (True,) + batch.dims))]
     dims = tuple(b for i, b in zip(index[1:] + (slice(None),) * len(batch.dims),
                                    batch.dims)
                  if not isinstance(i, int)) # could be faster
+    if batch.all_valid:
+        return MaskedBatch(data, None, dims, None, True)
+    mask = batch.mask[tuple(i if b else 0 if isinstance(i, int) else slice(None)
+                       for i, b in zip(index, (True,) + batch.dims))]
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.__getitem__ = getitem
+
+def index_select(batch, dim, index):
+    if not isinstance(batch, MaskedBatch):
+        return torch.index_select(batch, dim, index)
+    if dim < 0:
+        dim += batch.dim()
+    if dim > 0 and batch.dims[dim - 1]:
+        raise NotImplementedError("cannot index_select over dynamic dim")
+    data = batch.data.index_select(dim, index)
+    if dim > 0:
+        if batch.lengths is not None or batch.all_valid:
+            return MaskedBatch(data, None, batch.dims, batch.lengths,
+                               batch.all_valid)
+        return MaskedBatch(data, batch.mask, batch.dims)
+    if batch.lengths is not None:
+        lengths = tuple(None if l is None else l.index_select(0, index)
+                        for l in batch.lengths)
+        return MaskedBatch(data, None, batch.dims, lengths, batch.all_valid)
+    if batch.all_valid:
+        return MaskedBatch(data, None, batch.dims, None, True)
+    return MaskedBatch(data, batch.mask.index_select(0, index), batch.dims)
+
+MaskedBatch.index_select = index_select
@@ -4,27 +4,46 @@
 # For full license text, see the LICENSE file in the repo root
 # or https://opensource.org/licenses/BSD-3-Clause
 
+import math
+
 import torch
 from torch.nn import functional as F
 
-from matchbox import MaskedBatch
+from matchbox import MaskedBatch, PackedBatch
 from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
+from matchbox.patching import patch
 
 def dropout(batch, p=0.5, training=False, inplace=False):
     if not isinstance(batch, MaskedBatch):
         return F.dropout(batch, p, training, inplace)
+    if not inplace:
+        # in place, the caller's batch itself has to change
+        batch = batch._maybe_pack()
+    if isinstance(batch, PackedBatch):
+        values = F.dropout(batch.values, p, training, inplace)
+        return PackedBatch(values, batch.lengths, batch.dims)
     data = F.dropout(batch.data, p, training, inplace)
+    if batch.lengths is not None or batch.all_valid:
+        return MaskedBatch(data, None, batch.dims, batch.lengths,
+                           batch.all_valid)
     return MaskedBatch(data, batch.mask, batch.dims)
 
 MaskedBatch.dropout = dropout
-TENSOR_TYPE.dropout = dropout
+patch(TENSOR_TYPE, 'dropout', dropout)
 
 def linear(batch, weight, bias=None):
     if not isinstance(batch, MaskedBatch):
         return F.linear(batch, weight, bias)
     if batch.dims[-1]:
         raise ValueError("cannot contract static and dynamic dimensions")
+    batch = batch._maybe_pack()
+    if isinstance(batch, PackedBatch):
+        values = F.linear(batch.values, weight, bias)
+        return PackedBatch(values, batch.lengths, batch.dims)
     data = F.linear(batch.data, weight, bias)
+    if batch.lengths is not None or batch.all_valid:
+        return MaskedBatch(data, None, batch.dims, batch.lengths,
+                           batch.all_valid)
     return MaskedBatch(data, batch.mask, batch.dims)
 
 def embedding(batch, weight, padding_idx=None, max_norm=None, norm_type=2,
@@ -42,14 +61,67 @@ def embedding(batch, weight, padding_idx=None, max_norm=None, norm_type=2,
     if not isinstance(batch, MaskedBatch):
         return compat_embedding(batch, weight, padding_idx, max_norm, norm_type,
                                 scale_grad_by_freq, sparse)
+    if isinstance(batch, PackedBatch):
+        values = compat_embedding(batch.values, weight, padding_idx, max_norm,
+                                  norm_type, scale_grad_by_freq, sparse)
+        return PackedBatch(values, batch.lengths, batch.dims + (False,))
     #data = batch.data - batch.mask
     data = batch.data
     data = compat_embedding(
         data, weight, padding_idx, max_norm, norm_type, scale_grad_by_freq, sparse)
-    mask = batch.mask.unsqueeze(-1).float()
     dims = batch.dims + (False,)
+    if batch.lengths is not None or batch.all_valid:
+        lengths = None if batch.lengths is None else batch.lengths + (None,)
+        return MaskedBatch(data, None, dims, lengths, batch.all_valid)
+    mask = batch.mask.unsqueeze(-1)
     return MaskedBatch(data, mask, dims)
 
+def _layer_norm(input, normalized_shape, weight=None, bias=None, eps=1e-5):
+    # F.layer_norm for torch < 0.4, which doesn't have it
+    size = input.size()
+    x = input.contiguous().view(
+        *(size[:input.dim() - len(normalized_shape)] + (-1,)))
+    x = x - x.mean(-1, keepdim=True)
+    x = x / ((x * x).mean(-1, keepdim=True) + eps).sqrt()
+    x = x.view(*size)
+    if weight is not None:
+        x = x * weight
+    if bias is not None:
+        x = x + bias
+    return x
+
+compat_layer_norm = getattr(F, 'layer_norm', _layer_norm)
+
+def layer_norm(batch, normalized_shape, weight=None, bias=None, eps=1e-5):
+    if isinstance(normalized_shape, int):
+        normalized_shape = (normalized_shape,)
+    if not isinstance(batch, MaskedBatch):
+        return compat_layer_norm(batch, normalized_shape, weight, bias, eps)
+    if any(batch.dims[-len(normalized_shape):]):
+        raise NotImplementedError("cannot layer_norm over dynamic dims")
+    batch = batch._maybe_pack()
+    # statistics are per position, so padding positions can't affect valid
+    # ones and the input mask carries over unchanged
+    if isinstance(batch, PackedBatch):
+        values = compat_layer_norm(batch.values, normalized_shape, weight,
+                                   bias, eps)
+        return PackedBatch(values, batch.lengths, batch.dims)
+    data = compat_layer_norm(batch.data, normalized_shape, weight, bias, eps)
+    if batch.lengths is not None or batch.all_valid:
+        return MaskedBatch(data, None, batch.dims, batch.lengths,
+                           batch.all_valid)
+    return MaskedBatch(data, batch.mask, batch.dims)
+
+def _masked_softmax(fn, batch, dim):
+    # padding gets an additive bias of -inf, so it has zero probability without
+    # renormalizing (this is also much cheaper than a broadcasting masked_fill);
+    # rows with no valid entries get no bias rather than coming out as NaN, and
+    # are zeroed along with the rest of the output padding by the caller (masks
+    # needn't be prefixes along dim, e.g. after causal_mask(1, 2))
+    mask = batch.mask
+    bias = mask | mask.long().sum(dim, keepdim=True).eq(0)
+    return fn(batch.data + bias.type_as(batch.data).log(), dim), mask
+
 def softmax(batch, dim=-1):
     if not isinstance(batch, MaskedBatch):
         return F.softmax(batch, dim)
@@ -57,20 +129,92 @@ def softmax(batch, dim=-1):
         raise ValueError("cannot softmax over batch dimension")
     elif dim < 0:
         dim += batch.dim()
-    dims = batch.dims
+    dims, lengths = batch.dims, batch.lengths
+    if isinstance(batch, PackedBatch) and not dims[dim - 1]:
+        return PackedBatch(F.softmax(batch.values, dim - 1), lengths, dims)
     if dims[dim - 1]:
-        data = F.softmax(batch.data * batch.mask, dim) * batch.mask
-        data = data / data.sum(dim, keepdim=True)
-        data[data.ne(data).detach()] = 0 # remove NaNs
-        mask = batch.mask.narrow(dim, 0, 1)
+        if batch.all_valid:
+            data, mask = F.softmax(batch.data, dim), None
+        else:
+            data, mask = _masked_softmax(F.softmax, batch, dim)
+            data = data * mask.type_as(data)
+            mask = None if lengths is not None else mask.narrow(dim, 0, 1)
         dims = dims[:dim - 1] + (False,) + dims[dim:]
+        if lengths is not None:
+            lengths = lengths[:dim - 1] + (None,) + lengths[dim:]
     else:
         data = F.softmax(batch.data, dim)
-        mask = batch.mask
-    return MaskedBatch(data, mask, dims)
+        mask = batch.mask if lengths is None and not batch.all_valid else None
+    return MaskedBatch(data, mask, dims, lengths, batch.all_valid)
 
 MaskedBatch.softmax = softmax
-TENSOR_TYPE.softmax = softmax
+patch(TENSOR_TYPE, 'softmax', softmax)
+
+_tensor_log_softmax = TENSOR_TYPE.log_softmax
+
+def log_softmax(batch, dim=-1):
+    if not isinstance(batch, MaskedBatch):
+        return _tensor_log_softmax(batch, dim)
+    if dim == 0:
+        raise ValueError("cannot log_softmax over batch dimension")
+    elif dim < 0:
+        dim += batch.dim()
+    dims, lengths = batch.dims, batch.lengths
+    if isinstance(batch, PackedBatch) and not dims[dim - 1]:
+        return PackedBatch(F.log_softmax(batch.values, dim - 1), lengths,
+                           dims)
+    # unlike softmax, the output keeps the input's mask: padding has a log
+    # probability of -inf, so it can't become valid data the way zeros can
+    if dims[dim - 1] and not batch.all_valid:
+        data, mask = _masked_softmax(F.log_softmax, batch, dim)
+        data = data.masked_fill(mask.eq(0), 0)
+    else:
+        data = F.log_softmax(batch.data, dim)
+    if lengths is not None or batch.all_valid:
+        return MaskedBatch(data, None, dims, lengths, batch.all_valid)
+    return MaskedBatch(data, batch.mask, dims)
+
+MaskedBatch.log_softmax = log_softmax
+patch(TENSOR_TYPE, 'log_softmax', log_softmax)
+
+def _attention_fallback(query, key, value, causal, scale, p, training):
+    scores = (query @ key.transpose(key.dim() - 2, key.dim() - 1)) * scale
+    if causal:
+        scores = scores.causal_mask(in_dim=2, out_dim=1)
+    return dropout(softmax(scores, -1), p, training) @ value
+
+def attention(query, key, value, causal=False, scale=None, p=0,
+              training=False):
+    """Scaled dot-product attention of batch x ... x time x channel `query`
+    over `key` and `value`, where query position i only attends to key
+    positions j <= i if `causal`. Key padding and causality are applied as
+    additive biases built from the key's batch x time mask and from
+    positions, so no time x time masks are materialized; other layouts fall
+    back to composing matmul, causal_mask, softmax and dropout."""
+    args = (query, key, value)
+    batches = [x for x in args if isinstance(x, MaskedBatch)]
+    if scale is None:
+        scale = 1 / math.sqrt(query.size(-1) if not isinstance(
+            query, MaskedBatch) else query.data.size(-1))
+    if any(x.dim() < 3 or x.dims[-1] for x in batches):
+        return _attention_fallback(
+            query, key, value, causal, scale, p, training)
+    q, k, v = (x.data if isinstance(x, MaskedBatch) else x for x in args)
+    scores = (q @ k.transpose(-2, -1)) * scale
+    if isinstance(key, MaskedBatch) and key.dims[-2] and not key.all_valid:
+        scores = scores + key.mask.transpose(-2, -1).type_as(scores).log()
+    if causal:
+        scores = scores + scores.new(*scores.size()[-2:]).fill_(
+            -float('inf')).triu(1)
+    data = F.dropout(F.softmax(scores, -1), p, training) @ v
+    if isinstance(query, MaskedBatch):
+        if query.lengths is not None or query.all_valid:
+            return MaskedBatch(data, None, query.dims, query.lengths,
+                               query.all_valid)
+        return MaskedBatch(data, query.mask, query.dims)
+    if batches:
+        return MaskedBatch(data, None, (False,) * (data.dim() - 1), None, True)
+    return data
 
 def cross_entropy(input, target, weight=None, size_average=True,
                   ignore_index=-1, reduce=True):
@@ -80,7 +224,12 @@ def cross_entropy(input, target, weight=None, size_average=True,
                               weight, size_average, ignore_index, reduce)
         if reduce: return ret
         return ret.view(input.size(0), input.size(1))
-    target_data = (target.data + target.mask - 1).view(-1)
+    all_valid = input.all_valid and target.all_valid
+    if all_valid:
+        target_data = target.data.contiguous().view(-1)
+    else:
+        target_data = target.data.masked_fill(
+            target.mask.eq(0), ignore_index).view(-1)
     input_data = input.data.view(target_data.size(0), -1)
     if ignore_index != -1:
         raise ValueError("cannot set ignore_index with MaskedBatch")
@@ -88,5 +237,46 @@ def cross_entropy(input, target, weight=None, size_average=True,
         input_data, target_data, weight, size_average, ignore_index, reduce)
     if reduce: return data
     data = data.view(input.maxsize(0), input.maxsize(1))
-    mask = input.mask.squeeze(-1) * target.mask.float()
+    if all_valid:
+        return MaskedBatch(data, None, target.dims, target.lengths, True)
+    mask = input.mask.squeeze(-1) & target.mask
     return MaskedBatch(data, mask, target.dims)
+
+def linear_cross_entropy(input, target, weight, bias=None, size_average=True,
+                         reduce=True):
+    # cross_entropy(linear(input, weight, bias), target) computing logits only
+    # for valid positions, so the (often vocabulary-sized) projection and
+    # softmax never run on padding; the mean is over real tokens
+    if not isinstance(input, MaskedBatch) and not isinstance(target, MaskedBatch):
+        return cross_entropy(F.linear(input, weight, bias), target,
+                             size_average=size_average, reduce=reduce)
+    # a plain Tensor operand is a padded batch with no padding
+    if not isinstance(input, MaskedBatch):
+        input = MaskedBatch(input, None, (False,) * (input.dim() - 1), None,
+                            True)
+    elif not isinstance(target, MaskedBatch):
+        target = MaskedBatch(target, None, (False,) * (target.dim() - 1),
+                             None, True)
+    if input.dims[-1]:
+        raise ValueError("cannot contract static and dynamic dimensions")
+    if isinstance(input, PackedBatch) and isinstance(target, PackedBatch):
+        hidden, labels, mask = input.values, target.values, None
+    elif input.all_valid and target.all_valid:
+        hidden = input.data.contiguous().view(-1, input.data.size(-1))
+        labels, mask = target.data.contiguous().view(-1), None
+    else:
+        mask = input.mask.squeeze(-1) & target.mask
+        hidden = input.data[mask.unsqueeze(-1).expand_as(input.data)].view(
+            -1, input.data.size(-1))
+        labels = target.data[mask]
+    data = F.cross_entropy(F.linear(hidden, weight, bias), labels, None,
+                           size_average, -1, reduce)
+    if reduce: return data
+    if mask is None:
+        if isinstance(target, PackedBatch):
+            return PackedBatch(data, target.lengths, target.dims)
+        data = data.view(target.data.size())
+        return MaskedBatch(data, None, target.dims, target.lengths, True)
+    data = data.new(*mask.size()).zero_().masked_scatter(mask, data)
+    dims = tuple(b1 or b2 for b1, b2 in zip(input.dims[:-1], target.dims))
+    return MaskedBatch(data, mask, dims)
@@ -9,45 +9,138 @@ import torch
 from matchbox import MaskedBatch
 from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
 
-def _reduce(fn, zero_preserving=False):
-    def inner(batch, dim=None, keepdim=False):
+def _dynamic(batch, dims):
+    # whether padding can reach a reduction over dims
+    return not batch.all_valid and __builtins__['any'](
+        batch.dims[d - 1] for d in dims)
+
+def _fill(batch, data, dims, value):
+    # data (shaped like batch.data) with padding set to value, if it matters
+    if not _dynamic(batch, dims):
+        return data
+    return data.masked_fill(batch.mask.eq(0), value)
+
+def _count(batch, dims):
+    # number of valid entries reduced into each entry of the (keepdim) output
+    data = batch.data
+    if not _dynamic(batch, dims):
+        n = 1
+        for d in dims:
+            n *= data.size(d)
+        return data.new(1).fill_(n)
+    if batch.lengths is not None:
+        count = data.new(data.size(0)).fill_(1)
+        for d in dims:
+            length = batch.lengths[d - 1]
+            count = count * (data.size(d) if length is None
+                             else length.type_as(data))
+        return count.view(-1, *(1 for _ in batch.dims))
+    count = batch.mask.type_as(data)
+    for d in dims:
+        count = count.sum(d, keepdim=True) * (
+            data.size(d) if batch.mask.size(d) == 1 else 1)
+    return count
+
+def _sum(batch, dims):
+    data = _fill(batch, batch.data, dims, 0)
+    for d in dims:
+        data = data.sum(d, keepdim=True)
+    return data
+
+def _mean(batch, dims):
+    if not _dynamic(batch, dims):
+        data = batch.data
+        for d in dims:
+            data = data.mean(d, keepdim=True)
+        return data
+    return _sum(batch, dims) / _count(batch, dims).clamp(min=1)
+
+def _var(batch, dims, unbiased=True):
+    if len(dims) == 1 and not _dynamic(batch, dims):
+        return batch.data.var(dims[0], unbiased, True)
+    count = _count(batch, dims)
+    mean = _sum(batch, dims) / count.clamp(min=1)
+    data = _fill(batch, batch.data - mean, dims, 0)
+    data = data * data
+    for d in dims:
+        data = data.sum(d, keepdim=True)
+    # empty entries (which are padding) get zero rather than NaN
+    return data / (count - int(unbiased)).masked_fill(count.eq(0), 1)
+
+def _std(batch, dims, unbiased=True):
+    return _var(batch, dims, unbiased).sqrt()
+
+def _extreme(name, fill):
+    # max or min, with the indices of the extremes if reducing one dim
+    def kernel(batch, dims):
+        data = _fill(batch, batch.data, dims, fill)
+        if len(dims) == 1:
+            return tuple(getattr(data, name)(dims[0], keepdim=True))
+        for d in dims:
+            data = getattr(data, name)(d, keepdim=True)[0]
+        return data
+    return kernel
+
+def _logsumexp(batch, dims):
+    data = _fill(batch, batch.data, dims, -float('inf'))
+    shift = data.detach()
+    for d in dims:
+        shift = shift.max(d, keepdim=True)[0]
+    # empty entries have no finite maximum to shift by
+    shift = shift.masked_fill(shift.eq(-float('inf')), 0)
+    data = (data - shift).exp()
+    for d in dims:
+        data = data.sum(d, keepdim=True)
+    return data.log() + shift
+
+def _reduce(kernel):
+    def inner(batch, dim=None, keepdim=False, **kwargs):
         if dim is None:
-            if not zero_preserving and __builtins__['any'](batch.dims):
-                raise NotImplementedError(
-                    "cannot reduce to scalar with non-zero-preserving kernel "
-                    "if dynamic dims present")
-            mask = batch.mask[(slice(None), *(0 for d in batch.dims))]
-            dims = ()
+            reduced = list(range(1, batch.dim()))
         else:
             if dim < 0:
                 dim += batch.dim()
-            if not zero_preserving and batch.dims[dim - 1]:
-                raise NotImplementedError("cannot reduce over dynamic dim "
-                                          "with non-zero-preserving kernel")
-            if keepdim:
-                mask = batch.mask[tuple(slice(0, 1) if i == dim else slice(None)
-                                        for i in range(batch.mask.dim()))]
-                dims = tuple(False if i == dim - 1 else d
-                             for i, d in enumerate(batch.dims))
-            else:
-                mask = batch.mask[tuple(0 if i == dim else slice(None)
-                                        for i in range(batch.mask.dim()))]
-                dims = tuple(d for i, d in enumerate(batch.dims)
-                             if i != dim - 1)
-        data = fn(batch.data * batch.mask, dim=dim, keepdim=keepdim)
-        return MaskedBatch(data, mask, dims)
+            if dim == 0:
+                raise ValueError("cannot reduce over batch dimension")
+            reduced = [dim]
+        data = kernel(batch, reduced, **kwargs)
+        if dim is None and isinstance(data, tuple):
+            data = data[0]
+        outputs = data if isinstance(data, tuple) else (data,)
+        if not keepdim:
+            for d in reversed(reduced):
+                outputs = tuple(x.squeeze(d) for x in outputs)
+        dims = tuple(False if i + 1 in reduced else b
+                     for i, b in enumerate(batch.dims)
+                     if keepdim or i + 1 not in reduced)
+        lengths, mask = batch.lengths, None
+        if lengths is not None:
+            lengths = tuple(None if i + 1 in reduced else l
+                            for i, l in enumerate(lengths)
+                            if keepdim or i + 1 not in reduced)
+        elif not batch.all_valid:
+            mask = batch.mask
+            for d in reversed(reduced):
+                mask = mask.narrow(d, 0, 1) if keepdim else mask.select(d, 0)
+        outputs = tuple(MaskedBatch(x, mask, dims, lengths, batch.all_valid)
+                        for x in outputs)
+        return outputs if isinstance(data, tuple) else outputs[0]
     return inner
 
-MaskedBatch.sum = _reduce(torch.sum, zero_preserving=True)
-MaskedBatch.mean = _reduce(torch.mean)
-MaskedBatch.std = _reduce(torch.std)
+MaskedBatch.sum = _reduce(_sum)
+MaskedBatch.mean = _reduce(_mean)
+MaskedBatch.var = _reduce(_var)
+MaskedBatch.std = _reduce(_std)
+MaskedBatch.max = _reduce(_extreme('max', -float('inf')))
+MaskedBatch.min = _reduce(_extreme('min', float('inf')))
+MaskedBatch.logsumexp = _reduce(_logsumexp)
 
 def any(batch):
-    return (batch.data * batch.mask).any()
+    return batch._masked_data(0).any()
 
 MaskedBatch.any = any
 
 def all(batch):
-    return (batch.data * batch.mask).all()
+    return batch._masked_data(1).all()
 
 MaskedBatch.all = all
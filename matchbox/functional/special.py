@@ -8,6 +8,7 @@ import torch
 
 from matchbox import MaskedBatch
 from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
+from matchbox.patching import patch
 
 def causal_mask(batch, in_dim, out_dim):
     '''if in_dim is indexed by i and out_dim by j, masks ret[i,j] where i > j'''
@@ -22,10 +23,10 @@ def causal_mask(batch, in_dim, out_dim):
         else:
             raise NotImplementedError("unsupported arguments for causal_mask")
     if in_dim == 1 and out_dim == 2:
-        mask = batch.mask * batch.mask.new(
+        mask = batch.mask & batch.mask.new(
             *batch.data.size()[1:]).fill_(1).triu(0).unsqueeze(0)
     elif in_dim == 2 and out_dim == 1:
-        mask = batch.mask * batch.mask.new(
+        mask = batch.mask & batch.mask.new(
             *batch.data.size()[1:]).fill_(1).tril(0).unsqueeze(0)
     else:
         raise NotImplementedError("unsupported arguments for causal_mask")
@@ -34,32 +35,34 @@ def causal_mask(batch, in_dim, out_dim):
     return MaskedBatch(batch.data, mask, dims)
 
 MaskedBatch.causal_mask = causal_mask
-TENSOR_TYPE.causal_mask = causal_mask
+patch(TENSOR_TYPE, 'causal_mask', causal_mask)
 
 def _synchronize(batch):
     if not isinstance(batch, MaskedBatch):
         return batch
     if any(batch.dims):
         raise ValueError("cannot synchronize batch with dynamic dimensions")
-    mask = batch.mask + (1 - batch.mask)
-    return MaskedBatch(batch.data, mask, batch.dims)
+    return MaskedBatch(batch.data, None, batch.dims,
+                       tuple(None for _ in batch.dims), True)
 
 MaskedBatch._synchronize = _synchronize
-TENSOR_TYPE._synchronize = _synchronize
+patch(TENSOR_TYPE, '_synchronize', _synchronize)
 
 def _update(batch, new, update_mask=None):
     if not isinstance(batch, MaskedBatch) and not isinstance(new, MaskedBatch):
         return new
-    update_mask = (new.mask.byte() if update_mask is None
-                   else update_mask.data * update_mask.mask)
+    if update_mask is None and new.all_valid:
+        return new
+    update_mask = (new.mask if update_mask is None
+                   else update_mask.data.ne(0) & update_mask.mask)
     if isinstance(batch, MaskedBatch):
         data = torch.where(update_mask, new.data, batch.data)
     else:
         data = torch.where(update_mask, new.data, batch)
-    return MaskedBatch(data, update_mask.type_as(data), new.dims)
+    return MaskedBatch(data, update_mask, new.dims)
 
 MaskedBatch._update = _update
-TENSOR_TYPE._update = _update
+patch(TENSOR_TYPE, '_update', _update)
 
 # def _for(closure, iterator):
 #     for i in iterator:
@@ -9,43 +9,102 @@ import torch
 from matchbox import MaskedBatch
 from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
 
+def _as_batch(tensor, batch):
+    # a plain Tensor is shared by every example, like torch.matmul of each
+    # example (of size 1 x ...) with it, so the dims it has that broadcast
+    # against (or come before) an example's first dim have to be singletons
+    ndim = batch.data.dim()
+    extra = tensor.dim() - (ndim - 1 if ndim > 2 else 2)
+    if extra > 0:
+        if any(size != 1 for size in tensor.size()[:extra]):
+            raise ValueError("Tensor operand of matmul would broadcast over "
+                             "the batch dimension")
+        tensor = tensor.view(tensor.size()[extra:])
+    tensor = tensor.unsqueeze(0)
+    return MaskedBatch(tensor, None, (False,) * (tensor.dim() - 1), None, True)
+
+def _full_lengths(batch):
+    if batch.lengths is not None:
+        return batch.lengths
+    # all_valid batches have the same (maximum) size in every example
+    bs = batch.data.size(0)
+    return tuple(batch.data.new(bs).long().fill_(batch.data.size(d + 1))
+                 if b else None for d, b in enumerate(batch.dims))
+
+def _broadcast(entries1, entries2, vec1, vec2, fill, combine):
+    # per-dim entries (dims or lengths) of matmul's output: leading dims are
+    # broadcast and contracted dims dropped, as are the singleton dims matmul
+    # adds to vector operands
+    if vec1:
+        entries1 = (fill,) + entries1
+    if vec2:
+        entries2 = entries2 + (fill,)
+    n = max(len(entries1), len(entries2)) - 2
+    lead1 = (fill,) * (n + 2 - len(entries1)) + entries1[:-2]
+    lead2 = (fill,) * (n + 2 - len(entries2)) + entries2[:-2]
+    return (tuple(combine(a, b) for a, b in zip(lead1, lead2)) +
+            (() if vec1 else entries1[-2:-1]) + (() if vec2 else entries2[-1:]))
+
+def _align(x, ndim, vec1, vec2):
+    # add the singleton dims that make x (data or mask of an operand with
+    # batch dim first) broadcast against the other operand like matmul does
+    if vec1:
+        x = x.unsqueeze(1)
+    if vec2:
+        x = x.unsqueeze(-1)
+    while x.dim() < ndim:
+        x = x.unsqueeze(1)
+    return x
+
+def _squeeze(x, vec1, vec2):
+    if vec2:
+        x = x.squeeze(-1)
+    if vec1:
+        x = x.squeeze(-1 if vec2 else -2)
+    return x
+
 def matmul(batch1, batch2):
     if not isinstance(batch1, MaskedBatch) and not isinstance(batch2, MaskedBatch):
         return batch1 @ batch2
-    if isinstance(batch1, MaskedBatch) and isinstance(batch2, MaskedBatch):
-        dims1 = len(batch1.dims)
-        dims2 = len(batch2.dims)
-        data1 = batch1.data * batch1.mask
-        data2 = batch2.data * batch2.mask
-        if dims1 == 1:
-            data1 = data1.unsqueeze(-2)
-        if dims2 == 1 and dims1 == 1:
-            data2 = data2.unsqueeze(-1)
-        data = data1 @ data2
-        if dims1 == 1 and dims2 == 1:
-            #if (batch1.dims[0] or batch2.dims[0]) and not batch1.mask.eq(batch2.mask).all():
-            #    raise ValueError("cannot contract non-matching dimensions")
-            mask = batch1.mask[:, :1]
-            dims = ()
-        if dims1 == 2 and dims2 == 1:
-            #if (batch1.dims[1] or batch2.dims[0]) and not batch1.mask[:, 0].eq(batch2.mask).all():
-            #    raise ValueError("cannot contract non-matching dimensions")
-            mask = batch1.mask[:, :, :1] @ batch2.mask[:, :1]
-            dims = batch1.dims[:1]
-        elif dims1 == 1 and dims2 == 2:
-            #if (batch1.dims[0] or batch2.dims[0]) and not batch1.mask.eq(batch2.mask[:, :, 0]).all():
-            #    raise ValueError("cannot contract non-matching dimensions")
-            mask = batch1.mask[:, :1].unsqueeze(-2) @ batch2.mask[:, :1, :]
-            dims = batch2.dims[1:]
-        elif dims1 == 2 and dims2 == 2:
-            #if (batch1.dims[1] or batch2.dims[0]) and not batch1.mask[:, 0].eq(batch2.mask[:, :, 0]).all():
-            #    raise ValueError("cannot contract non-matching dimensions")
-            mask = batch1.mask[:, :, :1] @ batch2.mask[:, :1, :]
-            dims = batch1.dims[:1] + batch2.dims[1:]
+    if not isinstance(batch1, MaskedBatch):
+        batch1 = _as_batch(batch1, batch2)
+    elif not isinstance(batch2, MaskedBatch):
+        batch2 = _as_batch(batch2, batch1)
+    dims1, dims2 = batch1.dims, batch2.dims
+    vec1, vec2 = len(dims1) == 1, len(dims2) == 1
+    ndim = max(len(dims1) + vec1, len(dims2) + vec2) + 1
+    data1, data2 = batch1.data, batch2.data
+    all_valid = batch1.all_valid and batch2.all_valid
+    if (dims1[-1] or dims2[0 if vec2 else -2]) and not all_valid:
+        # padding in the contracted dim would be summed into valid outputs;
+        # zeroing it on one side is enough since the other side's padding
+        # then gets multiplied by zero
+        if batch2.all_valid or (not batch1.all_valid and
+                                data1.numel() <= data2.numel()):
+            data1 = batch1._masked_data()
         else:
-            raise NotImplementedError("matmul not implemented with batches of 3+D tensors")
-    else:
-        raise NotImplementedError("matmul not implemented between MaskedBatch and tensor")
+            data2 = batch2._masked_data()
+    data = _squeeze(_align(data1, ndim, vec1, False) @
+                    _align(data2, ndim, False, vec2), vec1, vec2)
+    dims = _broadcast(dims1, dims2, vec1, vec2, False, lambda a, b: a or b)
+    if all_valid:
+        return MaskedBatch(data, None, dims, None, True)
+    if ((batch1.lengths is not None or batch1.all_valid) and
+            (batch2.lengths is not None or batch2.all_valid)):
+        # the output's valid region is the product of the operands' along the
+        # dims that aren't contracted, so its lengths are just theirs
+        lengths = _broadcast(
+            _full_lengths(batch1), _full_lengths(batch2), vec1, vec2, None,
+            lambda a, b: b if a is None else a)
+        return MaskedBatch(data, None, dims, lengths)
+    # likewise, the output mask is the broadcast of the operands' masks at the
+    # first position of the contracted dim (which is valid in any example
+    # that isn't empty)
+    mask1 = _align(batch1.mask, ndim, vec1, False)
+    mask2 = _align(batch2.mask, ndim, False, vec2)
+    mask = _squeeze(mask1.narrow(-1, 0, 1) & mask2.narrow(-2, 0, 1),
+                    vec1, vec2)
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.__matmul__ = matmul
+MaskedBatch.__rmatmul__ = lambda batch, other: matmul(other, batch)
@@ -8,6 +8,7 @@ import torch
 
 from matchbox import MaskedBatch
 from matchbox.compat import MAYBE_VARIABLE, TENSOR_TYPE
+from matchbox.patching import patch
 
 def split(batch, split_size_or_sections, dim=0):
     if not isinstance(batch, MaskedBatch):
@@ -15,12 +16,33 @@ def split(batch, split_size_or_sections, dim=0):
     if dim < 0:
         dim += batch.dim()
     if dim > 0 and batch.dims[dim - 1]:
+        if batch.lengths is not None:
+            return tuple(_split_lengths(batch, torch.split(
+                batch.data, split_size_or_sections, dim), dim))
+        if batch.all_valid:
+            return tuple(MaskedBatch(data, None, batch.dims, None, True)
+                         for data in torch.split(
+                             batch.data, split_size_or_sections, dim))
         return tuple(MaskedBatch(data, mask, batch.dims) for data, mask in zip(
             torch.split(batch.data, split_size_or_sections, dim),
             torch.split(batch.mask, split_size_or_sections, dim)))
+    if dim > 0 and (batch.lengths is not None or batch.all_valid):
+        return tuple(MaskedBatch(data, None, batch.dims, batch.lengths,
+                                 batch.all_valid)
+                     for data in torch.split(
+                         batch.data, split_size_or_sections, dim))
     return tuple(MaskedBatch(data, batch.mask, batch.dims) for data
                  in torch.split(batch.data, split_size_or_sections, dim))
 
+def _split_lengths(batch, pieces, dim):
+    start = 0
+    for data in pieces:
+        size = data.size(dim)
+        lengths = tuple((l - start).clamp(0, size) if i == dim - 1 else l
+                        for i, l in enumerate(batch.lengths))
+        yield MaskedBatch(data, None, batch.dims, lengths, batch.all_valid)
+        start += size
+
 MaskedBatch.split = split
 
 def chunk(batch, chunks, dim=0):
@@ -39,8 +61,13 @@ def cat(sequence, dim):
     if not isinstance(first, MaskedBatch):
         return torch.cat(sequence, dim)
     data = torch.cat([batch.data for batch in sequence], dim)
+    if all(batch.all_valid for batch in sequence):
+        lengths = None if first.dims[dim - 1] else first.lengths
+        return MaskedBatch(data, None, first.dims, lengths, True)
     if first.dims[dim - 1]:
         mask = torch.cat([batch.mask for batch in sequence], dim)
+    elif first.lengths is not None:
+        return MaskedBatch(data, None, first.dims, first.lengths)
     else:
         mask = first.mask
     return MaskedBatch(data, mask, first.dims)
@@ -54,36 +81,72 @@ def stack(sequence, dim, dynamic=None):
         return torch.stack(sequence, dim)
     if dim < 0:
         dim += first.dim() + 1
+    last = sequence[-1]
+    all_valid = all(batch.all_valid for batch in sequence)
     if dynamic is None:
-        dynamic = not first.mask.eq(sequence[-1].mask).all()
+        if all_valid:
+            dynamic = False
+        elif first.lengths is not None and last.lengths is not None:
+            dynamic = not all(l1 is l2 or l1.equal(l2) for l1, l2 in zip(
+                first.lengths, last.lengths) if l1 is not None)
+        else:
+            dynamic = not first.mask.eq(last.mask).all()
     data = torch.cat([batch.data.unsqueeze(dim) for batch in sequence], dim)
+    dims = first.dims[:dim - 1] + (dynamic,) + first.dims[dim - 1:]
+    if all_valid:
+        return MaskedBatch(data, None, dims, None, True)
     if dynamic:
         mask = torch.cat(
             [batch.mask.unsqueeze(dim) for batch in sequence], dim)
+    elif first.lengths is not None:
+        lengths = first.lengths[:dim - 1] + (None,) + first.lengths[dim - 1:]
+        return MaskedBatch(data, None, dims, lengths)
     else:
         mask = first.mask.unsqueeze(dim)
-    dims = first.dims[:dim - 1] + (dynamic,) + first.dims[dim - 1:]
     return MaskedBatch(data, mask, dims)
 
-def unbind(batch, dim):
+def unbind(batch, dim, trim=False):
     if not isinstance(batch, MaskedBatch):
         return torch.unbind(batch, dim)
     if dim == 0:
         raise ValueError("cannot unbind over batch dimension")
+    if trim and batch.dims[dim - 1] and not batch.all_valid:
+        # leave out trailing steps that are padding for every example
+        lengths = batch._dynamic_lengths()[sum(batch.dims[:dim - 1])]
+        size = int(lengths.max())
+        if size < batch.data.size(dim):
+            data = batch.data.narrow(dim, 0, size)
+            if batch.lengths is not None:
+                batch = MaskedBatch(data, None, batch.dims, batch.lengths)
+            else:
+                batch = MaskedBatch(data, batch.mask.narrow(dim, 0, size),
+                                    batch.dims)
     dims = tuple(b for d, b in enumerate(batch.dims) if d != dim - 1)
+    if batch.all_valid:
+        lengths = None if batch.lengths is None else tuple(
+            l for d, l in enumerate(batch.lengths) if d != dim - 1)
+        return tuple(MaskedBatch(data, None, dims, lengths, True)
+                     for data in torch.unbind(batch.data, dim))
     if batch.dims[dim - 1]:
         return tuple(MaskedBatch(data, mask, dims)
                      for data, mask in zip(torch.unbind(batch.data, dim),
                                            torch.unbind(batch.mask, dim)))
+    elif batch.lengths is not None:
+        lengths = tuple(l for d, l in enumerate(batch.lengths) if d != dim - 1)
+        return tuple(MaskedBatch(data, None, dims, lengths)
+                     for data in torch.unbind(batch.data, dim))
     else:
         mask = batch.mask.squeeze(dim)
         return tuple(MaskedBatch(data, mask, dims)
                      for data in torch.unbind(batch.data, dim))
 
 MaskedBatch.unbind = unbind
-TENSOR_TYPE.unbind = unbind
+patch(TENSOR_TYPE, 'unbind', unbind)
 
 def contiguous(batch):
+    if batch.lengths is not None or batch.all_valid:
+        return MaskedBatch(batch.data.contiguous(), None, batch.dims,
+                           batch.lengths, batch.all_valid)
     return MaskedBatch(
         batch.data.contiguous(), batch.mask.contiguous(), batch.dims)
 
@@ -95,10 +158,12 @@ def view(batch, *sizes):
         raise ValueError("first dim in view must be 1, -1, or batch size")
     sizes = (bs,) + sizes[1:]
     data = batch.data.view(*sizes) # TODO can throw
+    dims = tuple(sizes[i] == -1 for i in range(1, len(sizes)))
+    if batch.all_valid:
+        return MaskedBatch(data, None, dims, None, True)
     mask_sizes = (bs,) + tuple(batch.data.size(i) if sizes[i] == -1 else 1
                                for i in range(1, len(sizes)))
     mask = batch.mask.view(*mask_sizes) # TODO can this throw if data doesn't?
-    dims = tuple(sizes[i] == -1 for i in range(1, len(sizes)))
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.view = view
@@ -115,19 +180,31 @@ def transpose(batch, dim1, dim2):
     if not isinstance(batch, MaskedBatch):
         return torch.transpose(batch, dim1, dim2)
     data = batch.data.transpose(dim1, dim2)
-    mask = batch.mask.transpose(dim1, dim2)
     dims = list(batch.dims)
     dims[dim1 - 1], dims[dim2 - 1] = dims[dim2 - 1], dims[dim1 - 1]
     dims = tuple(dims)
+    if batch.lengths is not None:
+        lengths = list(batch.lengths)
+        lengths[dim1 - 1], lengths[dim2 - 1] = (lengths[dim2 - 1],
+                                                lengths[dim1 - 1])
+        return MaskedBatch(data, None, dims, tuple(lengths), batch.all_valid)
+    if batch.all_valid:
+        return MaskedBatch(data, None, dims, None, True)
+    mask = batch.mask.transpose(dim1, dim2)
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.transpose = transpose
-TENSOR_TYPE.transpose = transpose
+patch(TENSOR_TYPE, 'transpose', transpose)
 
 def permute(batch, *permutation):
     data = batch.data.permute(*permutation)
-    mask = batch.mask.permute(*permutation)
     dims = tuple(batch.dims[i - 1] for i in permutation[1:])
+    if batch.lengths is not None and permutation[0] == 0:
+        lengths = tuple(batch.lengths[i - 1] for i in permutation[1:])
+        return MaskedBatch(data, None, dims, lengths, batch.all_valid)
+    if batch.all_valid:
+        return MaskedBatch(data, None, dims, None, True)
+    mask = batch.mask.permute(*permutation)
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.permute = permute
@@ -141,21 +218,30 @@ def split_dim(batch, dim, split_by):
              for d, s in enumerate(batch.data.size()))
     if not isinstance(batch, MaskedBatch):
         return batch.contiguous().view(*(n for tup in sizes for n in tup))
+    if dim > 0 and batch.dims[dim - 1]:
+        raise ValueError("cannot split dynamic dimension")
+    if batch.all_valid:
+        data = batch.data.contiguous().view(*(n for tup in sizes for n in tup))
+        dims = batch.dims[:dim] + (False,) + batch.dims[dim:]
+        return MaskedBatch(data, None, dims, None, True)
+    if batch.lengths is not None and dim > 0:
+        lengths = batch.lengths[:dim] + (None,) + batch.lengths[dim:]
+        data = batch.data.contiguous().view(*(n for tup in sizes for n in tup))
+        dims = batch.dims[:dim] + (False,) + batch.dims[dim:]
+        return MaskedBatch(data, None, dims, lengths)
     if dim == 0:
         msizes = ((s // split_by, split_by) if d == dim else (s,)
                  for d, s in enumerate(batch.mask.size()))
         mask = batch.mask.contiguous().view(*(n for tup in msizes for n in tup))
         mask = mask.narrow(1, 0, 1)
     else:
-        if batch.dims[dim - 1]:
-            raise ValueError("cannot split dynamic dimension")
         mask = batch.mask.unsqueeze(dim)
     data = batch.data.contiguous().view(*(n for tup in sizes for n in tup))
     dims = batch.dims[:dim] + (False,) + batch.dims[dim:]
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.split_dim = split_dim
-TENSOR_TYPE.split_dim = split_dim
+patch(TENSOR_TYPE, 'split_dim', split_dim)
 
 def join_dims(batch, dim1, dim2):
     if dim1 < 0:
@@ -175,6 +261,13 @@ def join_dims(batch, dim1, dim2):
     sizes = (batch.data.size(d + 1) * s if d == dim1 else s
              for d, s in enumerate(batch.data.size()) if d != dim1 + 1)
     data = batch.data.contiguous().view(*sizes)
+    dims = batch.dims[:dim1] + batch.dims[dim1 + 1:]
+    if batch.all_valid:
+        return MaskedBatch(data, None, dims, None, True)
+    if (batch.lengths is not None and dim1 > 0 and
+            not batch.dims[dim1 - 1] and not batch.dims[dim1]):
+        lengths = batch.lengths[:dim1] + batch.lengths[dim1 + 1:]
+        return MaskedBatch(data, None, dims, lengths)
     if dim1 == 0:
         mask = batch.mask.expand(*(s if d == dim1 + 1 else -1
                                    for d, s in enumerate(batch.data.size())))
@@ -183,11 +276,10 @@ def join_dims(batch, dim1, dim2):
         mask = mask.contiguous().view(*sizes)
     else:
         mask = batch.mask.squeeze(dim1 + 1)
-    dims = batch.dims[:dim1] + batch.dims[dim1 + 1:]
     return MaskedBatch(data, mask, dims)
 
 MaskedBatch.join_dims = join_dims
-TENSOR_TYPE.join_dims = join_dims
+patch(TENSOR_TYPE, 'join_dims', join_dims)
 
 def size_as_tensor(batch, dim):
     if not isinstance(batch, MaskedBatch):
@@ -198,6 +290,12 @@ def size_as_tensor(batch, dim):
         dim += batch.dim()
     if dim == 0 or not batch.dims[dim - 1]:
         return MAYBE_VARIABLE(torch.LongTensor([batch.data.size(dim)]))
+    if batch.lengths is not None:
+        return MaskedBatch(batch.lengths[dim - 1], None, (), (), True)
+    if batch.all_valid:
+        data = batch.data.new(batch.data.size(0)).long().fill_(
+            batch.data.size(dim))
+        return MaskedBatch(data, None, (), (), True)
     if any(batch.dims[:dim - 1] + batch.dims[dim:]):
         raise NotImplementedError("cannot get size in any of two or "
                                   "more dynamic dimensions")
@@ -206,10 +304,10 @@ def size_as_tensor(batch, dim):
     return MaskedBatch(data, mask, ())
 
 MaskedBatch.size_as_tensor = size_as_tensor
-TENSOR_TYPE.size_as_tensor = size_as_tensor
+patch(TENSOR_TYPE, 'size_as_tensor', size_as_tensor)
 
 def maxsize(batch, dim=None):
     return batch.data.size() if dim is None else batch.data.size(dim)
 
 MaskedBatch.maxsize = maxsize
-TENSOR_TYPE.maxsize = maxsize
+patch(TENSOR_TYPE, 'maxsize', maxsize)
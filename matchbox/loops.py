@@ -0,0 +1,109 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+# helpers called by the loops that `batch` rewrites; they live outside
+# `matchbox.functional` so that decorating a function doesn't import it
+
+import inspect
+
+import torch
+
+from . import MaskedBatch
+
+def _unbind(owner, *args, **kwargs):
+    # `owner.unbind(*args)` as the iterable of a for loop, which leaves out
+    # trailing steps that are padding for every example of a MaskedBatch
+    if isinstance(owner, MaskedBatch):
+        return owner.unbind(*args, trim=True, **kwargs)
+    if (inspect.ismodule(owner) and args and
+            isinstance(args[0], MaskedBatch)):
+        # torch.unbind(batch, dim) or F.unbind(batch, dim)
+        return args[0].unbind(*args[1:], trim=True, **kwargs)
+    return owner.unbind(*args, **kwargs)
+
+def _scatter_rows(full, index, batch):
+    if not isinstance(full, MaskedBatch):
+        return batch
+    data = full.data.index_copy(0, index, batch.data)
+    if full.all_valid and batch.all_valid and not any(full.dims):
+        return MaskedBatch(data, None, full.dims,
+                           tuple(None for _ in full.dims), True)
+    return MaskedBatch(data, full.mask.index_copy(0, index, batch.mask),
+                       full.dims)
+
+def _active_rows(batch, test=False):
+    # indices of the examples with any valid (and, for a test, true) entry
+    bs = batch.data.size(0)
+    active = batch.data.ne(0) & batch.mask if test else batch.mask
+    return active.view(bs, -1).long().sum(1).gt(0).nonzero().view(-1)
+
+class _ActiveSet(object):
+    """State of a while loop run by `@batch(compact=threshold)`, which narrows
+    loop variables to the examples that are still active once fewer than
+    `threshold` of them are, and scatters loop-carried ones back at exit."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.index = None
+        self.carried = None
+        self.inputs = None
+
+    def compact(self, test, carried, inputs):
+        if not isinstance(test, MaskedBatch):
+            return carried, inputs
+        bs = test.data.size(0)
+        keep = _active_rows(test, True)
+        if keep.numel() == bs or keep.numel() >= self.threshold * bs:
+            return carried, inputs
+        return self._select(keep, carried, inputs)
+
+    def _select(self, keep, carried, inputs):
+        if self.index is None:
+            self.index, self.carried, self.inputs = keep, carried, inputs
+        else:
+            self.carried = [_scatter_rows(f, self.index, x)
+                            for f, x in zip(self.carried, carried)]
+            self.index = self.index.index_select(0, keep)
+        select = lambda x: (x.index_select(0, keep)
+                            if isinstance(x, MaskedBatch) else x)
+        return [select(x) for x in carried], [select(x) for x in inputs]
+
+    def restore(self, carried, inputs):
+        if self.index is None:
+            return carried, inputs
+        carried = [_scatter_rows(f, self.index, x)
+                   for f, x in zip(self.carried, carried)]
+        inputs = self.inputs
+        self.index = self.carried = self.inputs = None
+        return carried, inputs
+
+class _ActivePrefix(_ActiveSet):
+    """State of a for loop over `unbind` run by `@batch(narrow=True)`, which
+    narrows each step and the loop variables to the prefix of the batch that
+    ends with the last example that is still active."""
+
+    def __init__(self):
+        super().__init__(1)
+
+    def compact(self, step, carried, inputs):
+        if not isinstance(step, MaskedBatch) or step.all_valid:
+            return step, carried, inputs
+        rows = _active_rows(step)
+        n = int(rows[-1]) + 1 if rows.numel() > 0 else 1
+        size = step.data.size(0) if self.index is None else self.index.numel()
+        if n < size:
+            keep = torch.arange(0, n, out=rows.new(n))
+            carried, inputs = self._select(keep, carried, inputs)
+            size = n
+        if size < step.data.size(0):
+            if step.lengths is not None:
+                lengths = tuple(None if l is None else l[:size]
+                                for l in step.lengths)
+                step = MaskedBatch(step.data[:size], None, step.dims, lengths)
+            else:
+                step = MaskedBatch(step.data[:size], step.mask[:size],
+                                   step.dims)
+        return step, carried, inputs
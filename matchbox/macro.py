@@ -5,11 +5,19 @@
 # or https://opensource.org/licenses/BSD-3-Clause
 
 from collections import defaultdict
+import copy
+import functools
+import hashlib
+import inspect
+import os
 
 import astor
 import gast
 
-from .recompile import compile_function, code_to_ast
+from . import __version__
+from . import patching
+from .loops import _ActiveSet, _ActivePrefix, _unbind
+from .recompile import compile_function, compile_cached, code_to_ast
 
 class FuseAttributes(gast.NodeTransformer):
     def visit_Attribute(self, node):
@@ -27,28 +35,132 @@ class SplitAttributes(gast.NodeTransformer):
         return gast.Attribute(gast.Name(value, node.ctx, None),
                               attr, node.ctx)
 
+def _decorator_name(node):
+    if isinstance(node, gast.Call):
+        node = node.func
+    if isinstance(node, gast.Attribute):
+        return node.attr
+    return node.id
+
+def _exits(body, breaks=True):
+    # whether a loop body can leave the loop other than through its test,
+    # i.e., has a return, or a break that isn't inside a nested loop
+    for child in body:
+        if isinstance(child, gast.Return) or (
+                breaks and isinstance(child, gast.Break)):
+            return True
+        if isinstance(child, (gast.FunctionDef, gast.ClassDef)):
+            continue
+        inner = [n for n in gast.iter_child_nodes(child)
+                 if isinstance(n, (gast.stmt, gast.excepthandler))]
+        if _exits(inner, breaks and
+                  not isinstance(child, (gast.For, gast.While))):
+            return True
+    return False
+
 class LoopAccumulation(gast.NodeTransformer):
+    def __init__(self, compact=None, narrow=False):
+        super().__init__()
+        self.compact = compact
+        self.narrow = narrow
+        self.locals = set()
+        self.n_active = 0
     def generic_visit(self, node):
         super().generic_visit(node)
         #print('generic:', astor.dump_tree(node))
         return node
     def visit_For(self, node):
         self.generic_visit(node)
-        return self.visit_loop(node)
+        unbind = (isinstance(node.iter, gast.Call) and
+                  isinstance(node.iter.func, gast.Attribute) and
+                  node.iter.func.attr == 'unbind')
+        if unbind:
+            # x.unbind(...) -> _matchbox_unbind(x, ...), which skips trailing
+            # steps that are padding for every example of a MaskedBatch
+            node.iter = gast.Call(
+                gast.Name('_matchbox_unbind', gast.Load(), None),
+                [node.iter.func.value] + node.iter.args, node.iter.keywords)
+        node, stores = self.accumulate(node, gast.NameConstant(value=None))
+        if not (self.narrow and unbind and isinstance(node.target, gast.Name)):
+            return node
+        return self.compact_loop(node, node.target.id, stores,
+                                 '_matchbox_ActivePrefix')
     def visit_While(self, node):
         self.generic_visit(node)
         if len(node.orelse) > 0:
             raise NotImplementedError("cannot process while-else")
         test = node.test
         node.test = gast.Call(gast.Attribute( # TODO any over dim 0
-            test, gast.Name('any', gast.Load(), None), None), [], [])
-        return self.visit_loop(node, test)
+            test, 'any', gast.Load()), [], [])
+        node, stores = self.accumulate(node, test)
+        if self.compact is None:
+            return node
+        return self.compact_loop(node, test, stores, '_matchbox_ActiveSet')
     def visit_FunctionDef(self, node):
+        outer_locals = self.locals
+        self.locals = {n.id for n in gast.walk(node)
+                       if isinstance(n, gast.Name) and
+                       isinstance(n.ctx, (gast.Store, gast.Param))}
         self.generic_visit(node)
+        self.locals = outer_locals
         node.decorator_list = [d for d in node.decorator_list
-                               if d.id != 'batch']
+                               if _decorator_name(d) != 'batch']
         return node
+    def compact_loop(self, node, test, stores, helper):
+        # _active = helper()
+        # while test.any():
+        #     [carried...], [inputs...] = _active.compact(
+        #         test, [carried...], [inputs...])
+        #     ...
+        # [carried...], [inputs...] = _active.restore(
+        #     [carried...], [inputs...])
+        # where for loops pass (and narrow) their step variable instead:
+        # for step in x.unbind(dim):
+        #     step, [carried...], [inputs...] = _active.compact(
+        #         step, [carried...], [inputs...])
+        step, assigned, loaded = None, set(), set()
+        if isinstance(test, str):
+            step, test = test, gast.Name(test, gast.Load(), None)
+            assigned.add(step)
+        for child in node.body + [test]:
+            for n in gast.walk(child):
+                if isinstance(n, gast.Name):
+                    if isinstance(n.ctx, gast.Store):
+                        assigned.add(n.id)
+                    elif isinstance(n.ctx, gast.Load):
+                        loaded.add(n.id)
+        carried = sorted(stores)
+        inputs = sorted((loaded & self.locals) - assigned)
+        if not carried and not inputs:
+            return node
+        if _exits(node.body):
+            raise NotImplementedError("cannot process break or return in a "
+                                      "compacted loop")
+        active = '_active_{}'.format(self.n_active)
+        self.n_active += 1
+        def names(ids, ctx):
+            return gast.List([gast.Name(i, ctx(), None) for i in ids], ctx())
+        def call(method, *args):
+            return gast.Call(gast.Attribute(
+                gast.Name(active, gast.Load(), None), method, gast.Load()),
+                list(args), [])
+        def assign(value, step=None):
+            targets = [names(carried, gast.Store), names(inputs, gast.Store)]
+            if step is not None:
+                targets.insert(0, gast.Name(step, gast.Store(), None))
+            return gast.Assign([gast.Tuple(targets, gast.Store())], value)
+        node.body.insert(0, assign(call(
+            'compact', test, names(carried, gast.Load),
+            names(inputs, gast.Load)), step))
+        init = gast.Assign(
+            [gast.Name(active, gast.Store(), None)],
+            gast.Call(gast.Name(helper, gast.Load(), None), [], []))
+        restore = assign(call(
+            'restore', names(carried, gast.Load), names(inputs, gast.Load)))
+        return [init, node, restore]
     def visit_loop(self, node, update_mask=gast.NameConstant(value=None)):
+        return self.accumulate(node, update_mask)[0]
+    def accumulate(self, node, update_mask):
         node = FuseAttributes().visit(node)
         loads, stores = defaultdict(list), set()
         for child in node.body:
@@ -68,8 +180,7 @@ class LoopAccumulation(gast.NodeTransformer):
                     child.value = gast.Call(
                         gast.Attribute(
                             gast.Name(name, gast.Load(), None),
-                            gast.Name('_update', gast.Load(), None),
-                            None),
+                            '_update', gast.Load()),
                         [child.value, update_mask], [])
                     stores.add(name)
         node = SplitAttributes().visit(node)
@@ -80,14 +191,91 @@ class LoopAccumulation(gast.NodeTransformer):
                 gast.Call(
                     gast.Attribute(
                         gast.Name(name, gast.Load(), None),
-                        gast.Name('_synchronize', gast.Load(), None),
-                        None),
+                        '_synchronize', gast.Load()),
                     [], []))
             synchronizes.append(synchronize)
         node.body.extend(synchronizes)
-        return node
+        return node, stores
+
+def _package_version(module):
+    version = getattr(module, '__version__', None)
+    if version is None:
+        try:
+            from importlib.metadata import version as get_version
+            version = get_version(module.__name__)
+        except ImportError:
+            pass
+    return str(version)
+
+# the parser, the transform and the helpers that the generated code calls,
+# relative to this package; they are read as files so that hashing them
+# doesn't import (and, in lazy mode, patch with) matchbox.functional
+_TRANSFORM_SOURCES = ('macro.py', 'loops.py',
+                      os.path.join('functional', 'special.py'),
+                      os.path.join('recompile', 'code_to_ast.py'))
+
+_transform_hash = None
+
+def transform_hash():
+    """Hex digest of everything besides a function's source and options
+    that the code generated by `batch` depends on: the source of the parser,
+    the transform and the helpers it calls, and the gast and astor versions."""
+    global _transform_hash
+    if _transform_hash is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        key = hashlib.sha256()
+        for path in _TRANSFORM_SOURCES:
+            with open(os.path.join(root, path), 'rb') as f:
+                key.update(f.read())
+        for module in (gast, astor):
+            key.update(_package_version(module).encode('utf-8'))
+        _transform_hash = key.hexdigest()
+    return _transform_hash
+
+def batch(fn=None, compact=None, narrow=False):
+    """Rewrite the control flow of `fn` to run on `MaskedBatch`es.
+
+    If `compact` is a fraction, `while` loops switch to running only on the
+    examples that are still active once the fraction of active examples drops
+    below it; loop-carried variables are scattered back into full batches and
+    other batch variables the loop reads are restored when the loop exits.
+
+    If `narrow` is true, each step of a `for` loop over `unbind` runs only on
+    the prefix of the batch that still has valid data at that step, which is
+    every active example if the batch is sorted by decreasing length (see
+    `MaskedBatch.sort_by_length`). Variables are restored the same way.
+    Loops rewritten like this can't contain `break` or `return`.
 
-def batch(fn):
-    node = code_to_ast(fn)
-    node = LoopAccumulation().visit(node)
-    return compile_function(node, fn.__globals__)
+    In lazy mode (see `matchbox.patching`), calls to the rewritten function
+    activate Matchbox's monkeypatches for their duration."""
+    if fn is None:
+        return functools.partial(batch, compact=compact, narrow=narrow)
+    def transform():
+        # the transform works in place, so leave the cached AST untouched
+        node = copy.deepcopy(code_to_ast(fn))
+        return LoopAccumulation(compact, narrow).visit(node)
+    try:
+        source = inspect.getsource(fn)
+    except (IOError, OSError, TypeError):
+        source = None
+    globals_ = dict(fn.__globals__, _matchbox_unbind=_unbind)
+    if compact is not None or narrow:
+        globals_.update(_matchbox_ActivePrefix=_ActivePrefix,
+                        _matchbox_ActiveSet=functools.partial(
+                            _ActiveSet, compact))
+    if source is None:
+        compiled = compile_function(transform(), globals_,
+                                    filename=fn.__code__.co_filename)
+    else:
+        key = hashlib.sha256('\0'.join(
+            (__version__, transform_hash(), repr((compact, narrow)),
+             source)).encode('utf-8'))
+        compiled = compile_cached(key.hexdigest(), fn.__name__, transform,
+                                  globals_, fn.__code__.co_filename)
+    if not patching.LAZY:
+        return compiled
+    @functools.wraps(compiled)
+    def inner(*args, **kwargs):
+        with patching.patched():
+            return compiled(*args, **kwargs)
+    return inner
@@ -0,0 +1,31 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+import os
+
+# position-wise ops (linear, dropout, layer_norm and elementwise unary ops)
+# pack a padded batch before running on it when fewer than this fraction of
+# its positions are valid; zero disables packing
+THRESHOLD = float(os.environ.get('MATCHBOX_PACK_THRESHOLD', '0'))
+
+class pack_below(object):
+    """Context manager that sets the fill ratio below which position-wise ops
+    convert their input to a `PackedBatch`. Their outputs stay packed, so a
+    chain of such ops (e.g., a feedforward block) pays for the gather once,
+    and the scatter back to padded data only happens when a later op needs it.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def __enter__(self):
+        global THRESHOLD
+        self._before, THRESHOLD = THRESHOLD, self.threshold
+        return self
+
+    def __exit__(self, *exc):
+        global THRESHOLD
+        THRESHOLD = self._before
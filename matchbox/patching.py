@@ -0,0 +1,72 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+import os
+
+# in lazy mode, Matchbox's monkeypatches of PyTorch (Tensor methods and the
+# `F` used by torch.nn modules) are only applied while `patched` is active
+LAZY = os.environ.get('MATCHBOX_LAZY', '0') not in ('', '0')
+
+_MISSING = object()
+_patches = []
+_depth = 0
+
+def _active():
+    return not LAZY or _depth > 0
+
+def _apply(patch):
+    owner, name, value, original = patch
+    setattr(owner, name, value)
+
+def _restore(patch):
+    owner, name, value, original = patch
+    if original is _MISSING:
+        delattr(owner, name)
+    else:
+        setattr(owner, name, original)
+
+def patch(owner, name, value):
+    """Replace `owner.name` with `value` whenever patching is active."""
+    p = (owner, name, value, vars(owner).get(name, _MISSING))
+    _patches.append(p)
+    if _active():
+        _apply(p)
+
+def set_lazy(lazy=True):
+    """Switch between applying patches for the whole process and only while
+    `patched` is active."""
+    global LAZY
+    before = _active()
+    LAZY = lazy
+    if _active() and not before:
+        for p in _patches:
+            _apply(p)
+    elif before and not _active():
+        for p in reversed(_patches):
+            _restore(p)
+
+class patched(object):
+    """Context manager that applies Matchbox's monkeypatches while it is
+    active (they are always applied unless Matchbox is in lazy mode). Entering
+    it also imports `matchbox.functional`. Scopes can be nested, but patches
+    are global, so they also affect other threads while any scope is active.
+    """
+
+    def __enter__(self):
+        global _depth
+        from . import functional
+        if _depth == 0 and LAZY:
+            for p in _patches:
+                _apply(p)
+        _depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        global _depth
+        _depth -= 1
+        if _depth == 0 and LAZY:
+            for p in reversed(_patches):
+                _restore(p)
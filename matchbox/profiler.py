@@ -0,0 +1,170 @@
+# Copyright (c) 2018, salesforce.com, inc.
+# All rights reserved.
+# Licensed under the BSD 3-Clause license.
+# For full license text, see the LICENSE file in the repo root
+# or https://opensource.org/licenses/BSD-3-Clause
+
+import functools
+import os
+import sys
+import time
+import types
+
+import torch
+
+from . import MaskedBatch, PackedBatch
+
+_MATCHBOX_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class OpStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.elements = 0
+        self.valid = 0
+        self.time = 0.0
+        self.bytes = 0
+
+    def add(self, elements, valid, time, bytes):
+        self.calls += 1
+        self.elements += elements
+        self.valid += valid
+        self.time += time
+        self.bytes += bytes
+
+    @property
+    def padding(self):
+        """Fraction of the input elements that are padding."""
+        return 1 - self.valid / self.elements if self.elements else 0.0
+
+    def __repr__(self):
+        return ("OpStats(calls={}, elements={}, valid={}, time={:.6f}, "
+                "bytes={})".format(self.calls, self.elements, self.valid,
+                                   self.time, self.bytes))
+
+def _count(batch):
+    """Number of total and valid (non-padding) elements in a batch."""
+    if isinstance(batch, PackedBatch):
+        return batch.values.numel(), batch.values.numel()
+    elements = batch.data.numel()
+    if batch.all_valid:
+        return elements, elements
+    valid = int(batch.mask.long().sum())
+    for size, b in zip(batch.data.size()[1:], batch.dims):
+        if not b:
+            valid *= size
+    return elements, valid
+
+def _nbytes(x):
+    if isinstance(x, PackedBatch):
+        return x.values.numel() * x.values.element_size()
+    if isinstance(x, MaskedBatch):
+        n = x.data.numel() * x.data.element_size()
+        if x._mask is not None:
+            n += x._mask.numel() * x._mask.element_size()
+        return n
+    if torch.is_tensor(x) or isinstance(x, torch.autograd.Variable):
+        return x.numel() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(_nbytes(y) for y in x)
+    return 0
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.abspath(
+            frame.f_code.co_filename).startswith(_MATCHBOX_DIR):
+        frame = frame.f_back
+    if frame is None:
+        return None, None
+    return frame.f_code.co_filename, frame.f_lineno
+
+class profile(object):
+    """Context manager that records, for every `matchbox.functional` op
+    called on a `MaskedBatch` while it is active, the number of input elements
+    and how many of them are valid (i.e., not padding), the wall time and the
+    bytes of the op's outputs. Results are aggregated per op in `ops` and per
+    op and call site (the first frame outside Matchbox) in `sites`.
+
+    Ops called by other ops are attributed to the outermost op. Set
+    `synchronize=False` to skip synchronizing CUDA around each op, which makes
+    the timings of asynchronous ops unreliable.
+
+        with matchbox.profile() as prof:
+            model(batch)
+        print(prof.table())
+    """
+
+    _active = None
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.ops = {}
+        self.sites = {}
+        self._patched = []
+        self._depth = 0
+
+    def __enter__(self):
+        if profile._active is not None:
+            raise RuntimeError("matchbox.profile is already active")
+        from . import functional
+        profile._active = self
+        for owner in (MaskedBatch, functional):
+            for name, fn in list(vars(owner).items()):
+                if (isinstance(fn, types.FunctionType) and
+                        fn.__module__.startswith(functional.__name__)):
+                    self._patched.append((owner, name, fn))
+                    setattr(owner, name, self._wrap(name, fn))
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, fn in reversed(self._patched):
+            setattr(owner, name, fn)
+        self._patched = []
+        profile._active = None
+
+    def _wrap(self, name, fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            batch = next((x for x in args if isinstance(x, MaskedBatch)),
+                         None)
+            if batch is None or self._depth > 0:
+                return fn(*args, **kwargs)
+            elements, valid = _count(batch)
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                out = fn(*args, **kwargs)
+                if self.synchronize:
+                    torch.cuda.synchronize()
+            finally:
+                self._depth -= 1
+            elapsed = time.perf_counter() - start
+            stats = (elements, valid, elapsed, _nbytes(out))
+            self.ops.setdefault(name, OpStats()).add(*stats)
+            self.sites.setdefault((name,) + _call_site(), OpStats()).add(
+                *stats)
+            return out
+        return inner
+
+    def table(self, by='op', sort_by='time'):
+        """Format the aggregates `by` op or call site as a table, sorted in
+        descending order by an `OpStats` attribute."""
+        if by == 'op':
+            rows = [(name, s) for name, s in self.ops.items()]
+        elif by == 'site':
+            rows = [('{} {}:{}'.format(name, os.path.basename(f or '?'), l),
+                     s) for (name, f, l), s in self.sites.items()]
+        else:
+            raise ValueError("by must be 'op' or 'site'")
+        rows.sort(key=lambda r: getattr(r[1], sort_by), reverse=True)
+        width = max([len(r[0]) for r in rows] + [2])
+        lines = ['{:<{w}} {:>7} {:>12} {:>8} {:>10} {:>12}'.format(
+            'op', 'calls', 'elements', 'padding', 'time (ms)', 'bytes',
+            w=width)]
+        for label, s in rows:
+            lines.append('{:<{w}} {:>7} {:>12} {:>7.1%} {:>10.3f} {:>12}'.format(
+                label, s.calls, s.elements, s.padding, s.time * 1e3, s.bytes,
+                w=width))
+        return '\n'.join(lines)
@@ -4,5 +4,5 @@
 # For full license text, see the LICENSE file in the repo root
 # or https://opensource.org/licenses/BSD-3-Clause
 
-from .compile_function import compile_function
+from .compile_function import compile_function, compile_cached
 from .code_to_ast import code_to_ast
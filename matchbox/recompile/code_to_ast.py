@@ -7,16 +7,23 @@
 # Copyright (c) 2013-2015 Berker Peksag
 
 import ast
+from collections import OrderedDict
+import hashlib
+import inspect
+import linecache
 import sys
 import os
+import textwrap
 
 import gast
 
 class CodeToAst(object):
     """Given a module, or a function that was compiled as part
-    of a module, re-compile the module into an AST and extract
-    the sub-AST for the function.  Allow caching to reduce
-    number of compiles.
+    of a module, compile the module or just the source of the
+    function into an AST.  Keep up to `maxsize` ASTs in an LRU
+    cache that is validated against the file's modification time
+    and, when that changed, the hash of the source; `hits` and
+    `misses` count lookups.
     Also contains static helper utility functions to
     look for python files, to parse python files, and to extract
     the file/line information from a code object.
@@ -57,20 +64,73 @@ class CodeToAst(object):
         fname = fname.replace('.pyc', '.py')
         return fname, linenum
 
-    def __init__(self, cache=None):
-        self.cache = cache or {}
+    @staticmethod
+    def get_stamp(fname):
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def get_source(fname, linenum):
+        """Returns the source of a whole file (if linenum is 0) or
+            of the block (e.g. function definition including its
+            decorators) that starts at line linenum.
+        """
+        linecache.checkcache(fname)
+        lines = linecache.getlines(fname)
+        if not lines:
+            raise IOError('could not get source of {}'.format(fname))
+        if linenum > 0:
+            lines = inspect.getblock(lines[linenum - 1:])
+        return ''.join(lines)
+
+    @staticmethod
+    def parse_source(source, fname, linenum):
+        """Parse the source returned by get_source into a gast AST
+            of the module or function, keeping the line numbers
+            of the file.
+        """
+        tree = ast.parse(textwrap.dedent(source), filename=fname)
+        if linenum > 1:
+            ast.increment_lineno(tree, linenum - 1)
+        tree = gast.ast_to_gast(tree)
+        if linenum == 0:
+            return tree
+        return next(obj for obj in gast.walk(tree)
+                    if isinstance(obj, gast.FunctionDef))
+
+    def __init__(self, cache=None, maxsize=128):
+        self.cache = OrderedDict() if cache is None else cache
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
 
     def __call__(self, codeobj):
         cache = self.cache
         key = self.get_file_info(codeobj)
-        result = cache.get(key)
-        if result is not None:
-            return result
-        fname = key[0]
-        cache[(fname, 0)] = mod_ast = gast.ast_to_gast(self.parse_file(fname))
-        for obj in gast.walk(mod_ast):
-            if isinstance(obj, gast.FunctionDef):
-                cache[(fname, obj.lineno)] = obj
-        return cache[key]
+        stamp = self.get_stamp(key[0])
+        entry = cache.get(key)
+        if entry is not None and stamp is not None and entry[0] == stamp:
+            self.hits += 1
+            cache.move_to_end(key)
+            return entry[2]
+        source = self.get_source(*key)
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if entry is not None and entry[1] == digest:
+            self.hits += 1
+            result = entry[2]
+        else:
+            self.misses += 1
+            result = self.parse_source(source, *key)
+        cache[key] = stamp, digest, result
+        cache.move_to_end(key)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = self.misses = 0
 
 code_to_ast = CodeToAst()
@@ -16,8 +16,13 @@
 #      limitations under the License.
 
 from __future__ import absolute_import
+import ast
+import atexit
+import linecache
 import os
+import shutil
 import tempfile
+import types
 from uuid import uuid4
 
 import astor
@@ -28,10 +33,47 @@ if six.PY3:
 else:
     import imp
 
+def _env_flag(name):
+    return os.environ.get(name, '0') not in ('', '0')
+
+_tempdir = None
+
+def _get_tempdir():
+    """One temporary directory per process, removed at exit."""
+    global _tempdir
+    if _tempdir is None:
+        _tempdir = tempfile.mkdtemp(prefix='matchbox_')
+        atexit.register(shutil.rmtree, _tempdir, True)
+    return _tempdir
+
+def cache_dir():
+    """Directory of the persistent compile cache, which is set by the
+    `MATCHBOX_CACHE_DIR` environment variable (an empty value disables it)."""
+    default = os.path.join(os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'matchbox')
+    return os.environ.get('MATCHBOX_CACHE_DIR', default)
+
+def _load_module(fname, module_name, globals_=None):
+    if six.PY3:
+        spec = util.spec_from_file_location(module_name, fname)
+        m = util.module_from_spec(spec)
+        spec.loader.exec_module(m)
+    else:
+        m = imp.load_source(module_name, fname)
+
+    # Update the modules namespace, keeping the names it defines itself (e.g.
+    # the compiled function when `globals_` holds the original under that name)
+    if globals_:
+        for name, value in globals_.items():
+            m.__dict__.setdefault(name, value)
+    return m
+
 def compile_file(source, globals_=None):
     """Compile by saving to file and importing that.
     Compiling the AST/source code this way ensures that the source code is
-    readable by e.g. `pdb` or `inspect`.
+    readable by e.g. `pdb` or `inspect`. The file is kept until the process
+    exits.
     Args:
     source: The code to compile, either as a string or as an AST.
     globals_: A dictionary of variables that should be available as globals in
@@ -44,41 +86,106 @@ def compile_file(source, globals_=None):
         source = astor.to_source(gast.gast_to_ast(source))
 
     # Write source to temporary file
-    tempdir = tempfile.mkdtemp()
-    uuid = str(uuid4().hex[:4])
-    tmpname = os.path.join(tempdir, 'matchbox_%s.py' % uuid)
+    uuid = str(uuid4().hex[:8])
+    tmpname = os.path.join(_get_tempdir(), 'matchbox_%s.py' % uuid)
     with open(tmpname, 'w') as f:
         f.write(source)
 
     # Load the temporary file as a module
-    module_name = 'matchbox_%s' % uuid
-    if six.PY3:
-        spec = util.spec_from_file_location(module_name, tmpname)
-        m = util.module_from_spec(spec)
-        spec.loader.exec_module(m)
-    else:
-        m = imp.load_source(module_name, tmpname)
+    return _load_module(tmpname, 'matchbox_%s' % uuid, globals_)
 
-    # Update the modules namespace
+
+def compile_memory(node, globals_=None, debug=None, filename=None):
+    """Compile an AST without touching the filesystem.
+    Unless debugging, the AST is compiled directly and keeps the line numbers
+    of the code it was parsed from, so tracebacks point into `filename`.
+    When debugging, source code is generated and registered with `linecache`
+    so that it is readable by e.g. `pdb` or `inspect`.
+    Args:
+    node: The AST to compile.
+    globals_: See `compile_file`.
+    debug: Whether to generate source code. Defaults to the value of the
+        `MATCHBOX_DEBUG` environment variable.
+    filename: The file `node` was parsed from.
+    Returns:
+    A module object containing the compiled code.
+    """
+    if debug is None:
+        debug = _env_flag('MATCHBOX_DEBUG')
+    module_name = 'matchbox_%s' % uuid4().hex[:8]
+    tree = gast.gast_to_ast(node)
+    if not isinstance(tree, ast.Module):
+        tree = ast.Module(body=[tree], type_ignores=[])
+    if debug:
+        source = astor.to_source(tree)
+        filename = '<%s>' % module_name
+        linecache.cache[filename] = (
+            len(source), None, source.splitlines(True), filename)
+        code = compile(source, filename, 'exec')
+    else:
+        code = compile(ast.fix_missing_locations(tree),
+                       filename or '<%s>' % module_name, 'exec')
+    m = types.ModuleType(module_name)
+    exec(code, m.__dict__)
     if globals_:
-        m.__dict__.update(globals_)
+        for name, value in globals_.items():
+            m.__dict__.setdefault(name, value)
     return m
 
 
-def compile_function(node, globals_=None):
+def compile_function(node, globals_=None, in_memory=None, debug=None,
+                     filename=None):
     """Convert an AST into a function with inspectable source.
-    This function uses `compile_file` internally, but instead of returning the
-    entire module it will return the function only.
+    This function uses `compile_file` (or `compile_memory`) internally, but
+    instead of returning the entire module it will return the function only.
     Args:
     node: A `FunctionDef` node or a `Module` node which contains at least one
         `FunctionDef` node. If a module contains multiple functions, a handle
         to the first one will be returned.
     globals_: See `compile_file`
+    in_memory: Whether to use `compile_memory`. Defaults to the value of the
+        `MATCHBOX_IN_MEMORY` environment variable.
+    debug, filename: See `compile_memory`
     Returns:
     A handle to the compiled function.
     Raises:
     TypeError: If the input is not a string or AST.
     ValueError: If no function can be found.
     """
-    module = compile_file(node, globals_)
+    if in_memory is None:
+        in_memory = _env_flag('MATCHBOX_IN_MEMORY')
+    if in_memory:
+        module = compile_memory(node, globals_, debug, filename)
+    else:
+        module = compile_file(node, globals_)
     return getattr(module, node.name)
+
+
+def compile_cached(key, name, make_node, globals_=None, filename=None):
+    """Like `compile_function`, but look the module up in the persistent
+    compile cache (see `cache_dir`) by `key`, a hex digest that must identify
+    everything the generated source depends on. `make_node` is only called on
+    a cache miss. The cached module is imported normally, so its bytecode is
+    also cached and shared between processes. The cache is bypassed when
+    compiling in memory.
+    """
+    directory = cache_dir()
+    if not directory or _env_flag('MATCHBOX_IN_MEMORY'):
+        return compile_function(make_node(), globals_, filename=filename)
+    module_name = 'matchbox_%s' % key
+    fname = os.path.join(directory, module_name + '.py')
+    if not os.path.exists(fname):
+        source = astor.to_source(gast.gast_to_ast(make_node()))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write then rename so concurrent processes never see a partial
+            # file
+            tmpname = '%s.%s.tmp' % (fname, uuid4().hex[:8])
+            with open(tmpname, 'w') as f:
+                f.write(source)
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            module = compile_file(source, globals_)
+            return getattr(module, name)
+    return getattr(_load_module(fname, module_name, globals_), name)
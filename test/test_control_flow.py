@@ -10,9 +10,17 @@ from torch import nn
 import matchbox
 from matchbox import functional as F
 from matchbox import MaskedBatch, batch
+from matchbox.recompile.code_to_ast import CodeToAst
 from matchbox.test_utils import mb_test, mb_assert
 
+import gast
+import pytest
+import importlib.util
+import inspect
+import os
 import random
+import subprocess
+import sys
 
 @batch
 def while_loop(x):
@@ -22,3 +30,103 @@ def while_loop(x):
 
 def test_while():
     mb_test(while_loop, (4, ()))
+
+@batch(compact=0.75)
+def compact_while_loop(x, y, z):
+    while x > 0:
+        y = y * 2 + x * z
+        x = x - 0.25
+    return x, y
+
+def test_while_compact():
+    mb_test(compact_while_loop, (8, ()), (8, ()), (8, ()))
+
+def exiting_while_loop(x, y):
+    while x > 0:
+        y = y * 2
+        if y.sum() > 100:
+            break
+        x = x - 0.25
+    return x, y
+
+def nested_break_while_loop(x, y):
+    while x > 0:
+        for yt in y.unbind(1):
+            break
+        x = x - 0.25
+    return x
+
+def test_while_compact_exit(monkeypatch):
+    # restoring the compacted variables would be skipped
+    monkeypatch.setenv('MATCHBOX_IN_MEMORY', '1')
+    with pytest.raises(NotImplementedError):
+        batch(exiting_while_loop, compact=0.5)
+    batch(nested_break_while_loop, compact=0.5)
+
+def countdown(x):
+    while x > 0:
+        x = x - 1
+    return x
+
+def test_compile_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('MATCHBOX_CACHE_DIR', str(tmpdir))
+    monkeypatch.delenv('MATCHBOX_IN_MEMORY', raising=False)
+    for i in range(2):
+        mb_test(batch(countdown), (4, ()))
+    assert len(tmpdir.listdir(lambda p: p.ext == '.py')) == 1
+    mb_test(batch(countdown, compact=0.5), (4, ()))
+    assert len(tmpdir.listdir(lambda p: p.ext == '.py')) == 2
+
+def test_compile_cache_transform_change(tmpdir, monkeypatch):
+    monkeypatch.setenv('MATCHBOX_CACHE_DIR', str(tmpdir))
+    monkeypatch.delenv('MATCHBOX_IN_MEMORY', raising=False)
+    mb_test(batch(countdown), (4, ()))
+    assert len(tmpdir.listdir(lambda p: p.ext == '.py')) == 1
+    # as if macro.py, loops.py, special.py, gast or astor had changed
+    monkeypatch.setattr(matchbox.macro, '_transform_hash', 'changed')
+    mb_test(batch(countdown), (4, ()))
+    assert len(tmpdir.listdir(lambda p: p.ext == '.py')) == 2
+
+def test_batch_lazy(tmpdir):
+    # in lazy mode, decorating a function doesn't import matchbox.functional
+    tmpdir.join('lazy_module.py').write(
+        'from matchbox import batch\n'
+        '@batch(compact=0.5)\n'
+        'def f(x):\n'
+        '    for xt in x.unbind(1):\n'
+        '        x = x - 1\n'
+        '    return x\n')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(matchbox.__file__)))
+    # (compiling through the cache, which hashes the transform's source)
+    env = dict(os.environ, MATCHBOX_LAZY='1', MATCHBOX_CACHE_DIR=str(tmpdir),
+               PYTHONPATH=os.pathsep.join([str(tmpdir), root]))
+    subprocess.check_call([sys.executable, '-c', 'import sys, lazy_module; '
+                           'assert "matchbox.functional" not in sys.modules'],
+                          env=env)
+
+def test_compile_in_memory(monkeypatch):
+    monkeypatch.setenv('MATCHBOX_IN_MEMORY', '1')
+    mb_test(batch(countdown), (4, ()))
+    monkeypatch.setenv('MATCHBOX_DEBUG', '1')
+    f = batch(countdown)
+    mb_test(f, (4, ()))
+    assert '_update' in inspect.getsource(f)
+
+def test_code_to_ast_cache(tmpdir):
+    cache = CodeToAst(maxsize=1)
+    assert cache(countdown).name == 'countdown'
+    assert cache(countdown) is cache(countdown)
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache(test_while)
+    assert len(cache.cache) == 1 and cache.misses == 2
+    fname = str(tmpdir.join('module.py'))
+    for i, body in enumerate(('x', 'x + 1')):
+        with open(fname, 'w') as f:
+            f.write('def f(x):\n    return {}\n'.format(body))
+        os.utime(fname, (i, i))
+        spec = importlib.util.spec_from_file_location('module', fname)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        node = cache(module.f)
+    assert isinstance(node.body[0].value, gast.BinOp)
+    assert cache.misses == 4
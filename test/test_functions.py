@@ -8,10 +8,13 @@ import torch
 from torch.autograd import Variable
 import matchbox
 from matchbox import functional as F
-from matchbox import MaskedBatch
-from matchbox.test_utils import mb_test, mb_assert
+from matchbox import MaskedBatch, PackedBatch
+from matchbox.compat import MASK_DTYPE, TENSOR_TYPE, TORCH_FUNCTION
+from matchbox.test_utils import mb_test, mb_rand, mb_assert, mb_assert_allclose
 
 import random
+import numpy as np
+import pytest
 
 def test_embedding():
     xs = [Variable(torch.LongTensor(1, random.randint(1, 3)).random_(5))
@@ -28,9 +31,121 @@ def test_std():
     mb_test(lambda x: x.std(2),
             (4, (True, 3), (False, 2)))
 
+def test_linear_cross_entropy():
+    lengths = [random.randint(1, 3) for i in range(4)]
+    xs = [Variable(torch.rand(1, n, 2)) for n in lengths]
+    ys = [Variable(torch.LongTensor(1, n).random_(5)) for n in lengths]
+    W, b = Variable(torch.rand(5, 2)), Variable(torch.rand(5))
+    xb = MaskedBatch.fromlist(xs, (True, False))
+    yb = MaskedBatch.fromlist(ys, (True,))
+    f = lambda x, y: F.linear_cross_entropy(x, y, W, b, reduce=False)
+    mb_assert(f, (xs, ys), (xb, yb), 4)
+    losses = torch.cat([f(x, y) for x, y in zip(xs, ys)], 1)
+    mb_assert_allclose(losses.mean(),
+                       F.linear_cross_entropy(xb, yb, W, b))
+    mb_assert_allclose(losses.mean(),
+                       F.linear_cross_entropy(xb.pack(), yb.pack(), W, b))
+    mb_assert_allclose(f(xb.pack(), yb.pack()).padded().examples(), f(xb, yb))
+    # a plain Tensor operand is the padded batch, all of it valid
+    for x, y in ((xb, yb.data), (xb.pack(), yb.data), (xb.data, yb)):
+        mb_assert_allclose(losses.mean(), F.linear_cross_entropy(x, y, W, b))
+        mb_assert_allclose(f(xb, yb).examples(), f(x, y))
+
+def test_pack_below():
+    W = Variable(torch.rand(3, 2))
+    f = lambda x: F.linear(F.dropout(F.relu(F.linear(x, W)), 0), W.t())
+    xs = [Variable(torch.rand(1, n, 2)) for n in (1, 4, 2)]
+    xb = MaskedBatch.fromlist(xs, (True, False))
+    for threshold in (0, 0.5):
+        with matchbox.pack_below(threshold):
+            assert not isinstance(f(xb), PackedBatch)
+    with matchbox.pack_below(0.9):
+        yb = f(xb)
+        mb_test(f, (4, (True, 3), (False, 2)))
+    assert isinstance(yb, PackedBatch)
+    mb_assert_allclose([f(x) for x in xs], yb)
+
+def test_pack_below_inplace():
+    W = Variable(torch.rand(2, 2))
+    xs = [Variable(torch.rand(1, n, 2)) for n in (1, 4, 2)]
+    xb = MaskedBatch.fromlist(xs, (True, False))
+    with matchbox.pack_below(0.9):
+        F.linear(xb, W)
+        xb.data.add_(1)
+        mb_assert_allclose([F.linear(x + 1, W) for x in xs], F.linear(xb, W))
+        # in-place ops change xb itself rather than a packed copy
+        F.dropout(xb, 1, True, True)
+        assert not isinstance(F.relu(xb, inplace=True), PackedBatch)
+        assert xb.data.eq(0).all()
+        mb_assert_allclose([F.linear(x * 0, W) for x in xs], F.linear(xb, W))
+
+def test_layer_norm():
+    W, b = Variable(torch.rand(2)), Variable(torch.rand(2))
+    mb_test(lambda x: F.layer_norm(x, (2,), W, b),
+            (4, (True, 3), (False, 2)))
+    mb_test(torch.nn.LayerNorm((3, 2)),
+            (4, (True, 3), (False, 3), (False, 2)))
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    pb = F.layer_norm(xb.pack(), 2)
+    assert isinstance(pb, PackedBatch)
+    mb_assert_allclose(F.layer_norm(xb, 2).examples(), pb.padded())
+    if hasattr(torch.nn.functional, 'layer_norm'):
+        from matchbox.functional.nnet import _layer_norm
+        x = Variable(torch.rand(4, 3, 2))
+        mb_assert_allclose(torch.nn.functional.layer_norm(x, (2,), W, b),
+                           _layer_norm(x, (2,), W, b))
+
+def test_masked_reductions():
+    for dim in (1, 2, -1):
+        mb_test(lambda x: (x.mean(dim), x.var(dim, unbiased=False),
+                           x.std(dim, keepdim=True), x.logsumexp(dim)),
+                (4, (True, 3), (False, 2)))
+        mb_test(lambda x: x.max(dim) + x.min(dim, keepdim=True),
+                (4, (True, 3), (False, 2)))
+    mb_test(lambda x: (x.mean(2), x.max(1)[0], x.logsumexp(2)),
+            (4, (True, 3), (True, 3)))
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    zb = MaskedBatch(xb.data, xb.mask, xb.dims)
+    for f in (lambda x: x.mean(1), lambda x: x.std(1), lambda x: x.max(1)[0],
+              lambda x: x.logsumexp(1)):
+        mb_assert_allclose(f(xb).examples(), f(zb))
+    for name in ('sum', 'mean', 'var', 'max', 'min'):
+        y = getattr(xb, name)()
+        assert y.dims == ()
+        np.testing.assert_allclose(
+            y.data.numpy(), [float(getattr(x, name)()) for x in xs], rtol=1e-4)
+
 def test_matmul():
     mb_test(lambda a, b: a @ b,
             (4, (True, 3), (False, 2)), (4, (False, 2), (True, 3)))
+    mb_test(lambda a, b: a @ b,
+            (4, (False, 2), (True, 3), (False, 2)),
+            (4, (False, 2), (False, 2), (True, 3)))
+    mb_test(lambda a, b: a @ b,
+            (4, (True, 3), (False, 2)), (4, (False, 2), (False, 2), (True, 3)))
+    mb_test(lambda a, w: a @ w,
+            (4, (True, 3), (False, 2)), (2, 5))
+    mb_test(lambda a, w: w @ a,
+            (4, (False, 2), (True, 3)), (5, 2))
+    mb_test(lambda a, w: a @ w,
+            (4, (False, 3)), (3, 5))
+    # the weight's first dim has the batch size, but is still shared
+    mb_test(lambda a, w: a @ w,
+            (4, (False, 4)), (4, 4))
+    mb_test(lambda a, w: a @ w,
+            (4, (False, 4)), (4,))
+    mb_test(lambda a, w: w @ a,
+            (4, (False, 4), (True, 3)), (4, 4))
+    mb_test(lambda a, w: w @ a,
+            (4, (False, 4), (True, 3)), (1, 4, 4))
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    yb = xb @ xb.transpose(1, 2)
+    assert yb._mask is None and yb.lengths is not None
+    zb = MaskedBatch(xb.data, xb.mask, xb.dims)
+    zb = zb @ zb.transpose(1, 2)
+    assert zb.lengths is None
+    mb_assert_allclose(yb.examples(), zb)
+    assert (yb.mask == zb.mask).all()
 
 def test_transpose():
     mb_test(lambda x: x.transpose(1, 2),
@@ -41,3 +156,187 @@ def test_causal_mask():
             (4, (False, 3), (False, 3)))
     mb_test(lambda x: (x @ x.transpose(1, 2)).causal_mask(2, 1).softmax() @ x,
             (4, (True, 3), (False, 2)))
+    mb_test(lambda x: x.causal_mask(1, 2).softmax(),
+            (4, (False, 3), (False, 3)))
+    mb_test(lambda x: (x @ x.transpose(1, 2)).causal_mask(1, 2).softmax() @ x,
+            (4, (True, 3), (False, 2)))
+
+def test_softmax():
+    mb_test(lambda x: x.softmax(1).transpose(1, 2) @ x,
+            (4, (True, 3), (False, 2)))
+    mb_test(lambda x: x.log_softmax(1) + x.log_softmax(),
+            (4, (True, 3), (False, 2)))
+    mb_test(lambda x: F.log_softmax(x @ x.transpose(1, 2), -1),
+            (4, (True, 3), (False, 2)))
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    yb = (xb @ xb.transpose(1, 2)).softmax()
+    assert (yb.data == yb.data).all()
+    pb = xb.pack().log_softmax(-1)
+    assert isinstance(pb, PackedBatch)
+    mb_assert_allclose(xb.log_softmax(-1).examples(), pb.padded())
+
+def test_attention():
+    mb_test(lambda q, k: F.attention(q, k, k),
+            (4, (True, 3), (False, 2)), (4, (True, 4), (False, 2)))
+    mb_test(lambda x: F.attention(x, x, x, causal=True),
+            (4, (True, 3), (False, 2)))
+    mb_test(lambda q, k: F.attention(q, k, k),
+            (4, (False, 3), (False, 2)), (1, 4, 2))
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    yb = (xb @ xb.transpose(1, 2) * 0.5).causal_mask(2, 1).softmax() @ xb
+    mb_assert_allclose(yb.examples(), F.attention(xb, xb, xb, True, 0.5))
+    xb = xb.split_dim(-1, 2).join_dims(0, -1)
+    assert xb.lengths is None
+    yb = (xb @ xb.transpose(1, 2)).softmax() @ xb
+    mb_assert_allclose(yb.examples(), F.attention(xb, xb, xb, scale=1))
+
+def test_packed():
+    W = Variable(torch.rand(3, 2))
+    f = lambda x: F.linear(x, W).relu() * 2 + x.sum(2, keepdim=True)
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    mb_assert(f, (xs,), (xb.pack(),), 4)
+    mb_assert(f, (xs,), (PackedBatch.fromlist(xs, xb.dims),), 4)
+
+def test_packed_roundtrip():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    xp = xb.pack()
+    assert xp.lengths[0].tolist() == [x.size(1) for x in xs]
+    mb_assert(lambda x: x, (xs,), (xp.padded(),), 4)
+    assert xp.all_valid == (min(xp.lengths[0]) == max(xp.lengths[0]))
+    assert xp._padded is None
+    xp = PackedBatch.fromlist([x[:, :1] for x in xs], xb.dims)
+    assert xp.all_valid and xp._padded is None
+
+def test_fromlist():
+    xs = [Variable(torch.rand(1, random.randint(1, 3), 2,
+                              random.randint(1, 3))) for i in range(4)]
+    xb = MaskedBatch.fromlist(xs, (True, False, True))
+    mb_assert(lambda x: x, (xs,), (xb,), 4)
+    mb_assert(lambda x: x.sum(1).sum(2), (xs,), (xb,), 4)
+
+def test_frompacked():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    values = torch.cat([x.squeeze(0) for x in xs], 0)
+    xp = MaskedBatch.frompacked(values, [x.size(1) for x in xs], (True, False))
+    mb_assert(lambda x: x, (xs,), (xp,), 4)
+
+def test_unbatch():
+    xs = [Variable(torch.rand(1, random.randint(1, 3), 2,
+                              random.randint(1, 3))) for i in range(4)]
+    xb = MaskedBatch.fromlist(xs, (True, False, True))
+    for xb in (xb, xb[:, :, :, 0].pack()):
+        ys = [x[:, :, :, 0] for x in xs] if xb.dim() == 3 else xs
+        for y, z, n in zip(ys, xb.unbatch(), xb.unbatch(numpy=True)):
+            assert z.size() == y.size() and n.shape == tuple(y.size())
+            np.testing.assert_allclose(y.data.numpy(), n)
+
+def test_lengths():
+    xs, xb = mb_rand(4, (True, 3), (False, 2), (True, 3))
+    assert xb.lengths[1] is None
+    yb = (xb.transpose(1, 3) * 2).sum(2)
+    assert yb._mask is None
+    assert yb.lengths[0].tolist() == [x.size(3) for x in xs]
+    mb_assert(lambda x: (x.transpose(1, 3) * 2).sum(2), (xs,), (xb,), 4)
+    sizes = xb.size_as_tensor(3)
+    assert sizes.data.tolist() == [x.size(3) for x in xs]
+
+def test_all_valid():
+    xs = [Variable(torch.rand(1, 3, 2)) for i in range(4)]
+    xb = MaskedBatch.fromlist(xs, (True, False))
+    assert xb.all_valid
+    f = lambda x: (x @ x.transpose(1, 2)).softmax() @ x + x.sum(1, True)
+    yb = f(xb)
+    assert yb.all_valid and yb._mask is None
+    mb_assert(f, (xs,), (xb,), 4)
+    xs[0] = xs[0][:, :2]
+    assert not MaskedBatch.fromlist(xs, (True, False)).all_valid
+
+def test_new_zeros():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    f = lambda x: x.new_ones(x.size(0), x.size_as_tensor(1), 5)
+    mb_assert(f, (xs,), (xb,), 4)
+    assert f(xb).mask.eq(xb.mask).all()
+
+def test_mask_dtype():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    for yb in (xb, xb.float() * 2, F.embedding(xb.long(), torch.rand(5, 2))):
+        assert yb.mask.dtype == MASK_DTYPE
+    yb = MaskedBatch(xb.data, xb.mask.float(), xb.dims)
+    assert yb.mask.dtype == MASK_DTYPE
+    mb_assert(lambda x: x.sum(1), (xs,), (yb,), 4)
+
+def test_sort_by_length():
+    xs, xb = mb_rand(6, (True, 5), (False, 2))
+    yb, inverse = xb.sort_by_length(1)
+    sizes = yb.size_as_tensor(1).data.tolist()
+    assert sizes == sorted(sizes, reverse=True)
+    assert yb.maxsize(1) == sizes[0]
+    mb_assert(lambda x: x, (xs,), (yb.index_select(0, inverse),), 6)
+    # a mask that isn't a box is not all valid, even with equal sizes
+    xb = MaskedBatch.fromlist([Variable(torch.rand(1, 3, 2))] * 4,
+                              (True, False))
+    xb = (xb @ xb.transpose(1, 2)).causal_mask(1, 2)
+    yb, inverse = xb.sort_by_length(1)
+    assert not yb.all_valid
+    assert (yb.mask == xb.mask).all()
+
+def test_regroup():
+    xs, xb = mb_rand(6, (True, 5), (False, 2))
+    f = lambda x: x.relu().sum(1)
+    groups, inverse = xb.regroup(8)
+    assert all(g.maxsize(0) * g.maxsize(1) <= 8 or g.maxsize(0) == 1
+               for g in groups)
+    mb_assert(f, (xs,), (xb,), 6)
+    mb_assert_allclose([f(x) for x in xs],
+                       MaskedBatch.ungroup([f(g) for g in groups], inverse))
+    mb_assert(lambda x: x, (xs,), (MaskedBatch.ungroup(groups, inverse),), 6)
+
+def test_profile():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    W = Variable(torch.rand(5, 2))
+    f = lambda x: F.linear(x, W).relu().sum(1)
+    relu = MaskedBatch.relu
+    with matchbox.profile() as prof:
+        mb_assert(f, (xs,), (xb,), 4)
+    assert MaskedBatch.relu is relu
+    valid = sum(x.numel() for x in xs)
+    assert prof.ops['linear'].calls == 1
+    assert prof.ops['linear'].valid == valid
+    assert prof.ops['linear'].elements == xb.data.numel()
+    assert prof.ops['relu'].valid == valid // 2 * 5
+    assert sum(s.calls for s in prof.sites.values()) == 3
+    assert 'linear' in prof.table() and 'linear' in prof.table('site')
+
+def test_patched():
+    from matchbox import patching
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    lazy = patching.LAZY
+    with matchbox.patched():
+        transpose, split_dim = TENSOR_TYPE.transpose, TENSOR_TYPE.split_dim
+    patching.set_lazy(True)
+    try:
+        assert TENSOR_TYPE.transpose is not transpose
+        assert not hasattr(TENSOR_TYPE, 'split_dim')
+        with matchbox.patched():
+            assert TENSOR_TYPE.split_dim is split_dim
+            with matchbox.patched():
+                mb_assert(lambda x: x.data + x, (xs,), (xb,), 4)
+            assert TENSOR_TYPE.transpose is transpose
+        assert TENSOR_TYPE.transpose is not transpose
+    finally:
+        patching.set_lazy(lazy)
+    assert (TENSOR_TYPE.transpose is transpose) != lazy
+
+@pytest.mark.skipif(not TORCH_FUNCTION,
+                    reason="PyTorch doesn't support __torch_function__")
+def test_torch_function():
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    mb_assert(lambda x: torch.exp(torch.add(x, 1)) * torch.sigmoid(x),
+              (xs,), (xb,), 4)
+    mb_assert(lambda x: torch.sum(torch.cat([x, x.data * 2 - x], 2), 1),
+              (xs,), (xb,), 4)
+    mb_assert(lambda x: torch.matmul(F.softmax(
+        torch.matmul(x, torch.transpose(x, 1, 2)), dim=-1), x),
+              (xs,), (xb,), 4)
+    with pytest.raises(TypeError):
+        torch.cumsum(xb, 1)
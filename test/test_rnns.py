@@ -10,7 +10,7 @@ from torch import nn
 import matchbox
 from matchbox import functional as F
 from matchbox import MaskedBatch, batch
-from matchbox.test_utils import mb_test, mb_assert
+from matchbox.test_utils import mb_test, mb_rand, mb_assert
 
 import random
 
@@ -133,3 +133,47 @@ class AccumBiRNNClass(nn.Module):
 def test_accum_birnn_class():
     mb_test(AccumBiRNNClass(1),
             (4, (True, 3), (False, 1)))
+
+@batch(narrow=True)
+def narrow_rnn(x, h0, cell):
+    h = h0
+    for xt in x.unbind(1):
+        h = cell(xt, h)
+    return h
+
+def test_rnn_narrow():
+    cell = nn.RNNCell(2, 2)
+    xs, _ = mb_rand(6, (True, 4), (False, 2))
+    xs.sort(key=lambda x: -x.size(1))
+    xb = MaskedBatch.fromlist(xs, (True, False))
+    h0s, h0b = mb_rand(6, (False, 2))
+    mb_assert(lambda x, h0: narrow_rnn(x, h0, cell),
+              (xs, h0s), (xb, h0b), 6)
+
+def test_rnn_trim():
+    cell = nn.RNNCell(2, 2)
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    h0s, h0b = mb_rand(4, (False, 2))
+    padded = MaskedBatch(torch.cat([xb.data, xb.data], 1),
+                         torch.cat([xb.mask, xb.mask & 0], 1), xb.dims)
+    assert len(padded.unbind(1, trim=True)) == xb.maxsize(1)
+    mb_assert(lambda x, h0: simple_rnn(x, h0, cell),
+              (xs, h0s), (padded, h0b), 4)
+
+@batch
+def torch_unbind_rnn(x, h0, cell):
+    h = h0
+    for xt in torch.unbind(x, 1):
+        h = cell(xt, h)
+    return h
+
+def test_rnn_unbind_tensor():
+    cell = nn.RNNCell(2, 2)
+    x, h0 = torch.rand(1, 3, 2), torch.rand(1, 2)
+    expected = cell(x[:, 2], cell(x[:, 1], cell(x[:, 0], h0)))
+    assert simple_rnn(x, h0, cell).data.equal(expected.data)
+    assert torch_unbind_rnn(x, h0, cell).data.equal(expected.data)
+    xs, xb = mb_rand(4, (True, 3), (False, 2))
+    h0s, h0b = mb_rand(4, (False, 2))
+    mb_assert(lambda x, h0: torch_unbind_rnn(x, h0, cell),
+              (xs, h0s), (xb, h0b), 4)